@@ -1,9 +1,28 @@
 __author__ = 'ocarrere'
 
-from .call import DeferredCallHandler
-from .queue import EventQueue, Event
-from .state import state
-from .state import StateValidationError
+import logging
+# Logging is left for the application to configure
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+from .call import DeferredCallHandler, coalesce, priority, offload
+from .call import wait_all, wait_any
+from .call import QueueFull, CallCancelled
+from .call import OVERFLOW_BLOCK, OVERFLOW_BLOCK_TIMEOUT, OVERFLOW_RAISE
+from .call import OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST
+from .metrics import MetricsSink, MetricsAggregator, prometheus_text
+from .pool import HandlerPool
+from .process import ProcessHandlerPool
+from .queue import EventQueue, PriorityEventQueue, Event
+from .queue import LOW_PRIORITY, NORMAL_PRIORITY, HIGH_PRIORITY
+from .remote import RemoteError
+from .ring import RingProducer, RingConsumer
+from .slicing import SlicePolicy
+from .tracing import Tracer, ChromeTraceRecorder, TraceContext
+from .tracing import add_tracer, remove_tracer
+from .tracing import current_context, set_context, start_trace
+from .transport import HandlerServer, HandlerClient
+from .state import state, state_machine, state_statistics
+from .state import StateRegistry, StateValidationError
 
 from ._version import get_versions
 __version__ = get_versions()['version']
@@ -1,102 +1,695 @@
-from gevent.event import AsyncResult
-from .queue import EventQueue
+from gevent import Timeout
+from gevent.event import Event
+from gevent.hub import Waiter, get_hub
+import gevent
+from gevent.queue import Empty, Full
+from .queue import EventQueue, PriorityEventQueue
+from . import tracing
+from .tracing import _tracers
 from logging import getLogger
+import collections
+import time
 
 _LOG = getLogger(__name__)
 
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_BLOCK_TIMEOUT = 'block_timeout'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_RAISE = 'raise'
+
+_MAX_CACHED_PROXIES = 64
+
+
+class QueueFull(Full):
+    pass
+
+
+class CallCancelled(Exception):
+    pass
+
 
 class _SyncCall(object):
+    __slots__ = ('name', '_args', '_kwargs', 'priority', 'offload', '_done',
+                 '_value', '_error', '_waiter', '_links', 'cancelled',
+                 '_on_cancel', 'enqueued_at', 'trace_context')
+
     def __init__(self, name, *args, **kwargs):
         self.name = name
         self._args = args
         self._kwargs = kwargs
-        self._result = AsyncResult()
+        self.offload = None
+        self._done = False
+        self._waiter = None
+        self._links = None
+        self.cancelled = False
+        # tells the target holding the call, such as a remote one
+        self._on_cancel = None
 
     def wait(self, timeout):
-        return self._result.get(timeout=timeout)
+        # Used by the sync proxies, whose caller is the only one ever
+        # waiting on the call. A bare waiter is far lighter than an
+        # AsyncResult, and is only needed if the call is still pending.
+        if not self._done:
+            self._waiter = Waiter()
+            timer = Timeout.start_new(timeout) if timeout is not None else None
+            try:
+                self._waiter.get()
+            except BaseException:
+                # Timed out or killed: nobody will be waiting for the
+                # result anymore.
+                self.cancelled = True
+                if self._on_cancel is not None:
+                    self._on_cancel()
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def get(self, timeout=None):
+        if not self._done:
+            self._wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _wait(self, timeout):
+        waiter = Waiter()
+        if self._waiter is None:
+            self._waiter = waiter
+        else:
+            self.rawlink(waiter.switch)
+        timer = Timeout.start_new(timeout) if timeout is not None else None
+        try:
+            waiter.get()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if self._waiter is waiter:
+                self._waiter = None
+            else:
+                self.unlink(waiter.switch)
+
+    def ready(self):
+        return self._done
+
+    def successful(self):
+        return self._done and self._error is None
+
+    @property
+    def exception(self):
+        return self._error if self._done else None
+
+    def rawlink(self, callback):
+        if self._done:
+            get_hub().loop.run_callback(callback, self)
+        elif self._links is None:
+            self._links = [callback]
+        else:
+            self._links.append(callback)
+
+    def unlink(self, callback):
+        if self._links is not None and callback in self._links:
+            self._links.remove(callback)
+
+    def cancel(self):
+        if self._done:
+            return False
+        self.cancelled = True
+        self._resolve(None, CallCancelled(
+            "Call to {} was cancelled".format(self.name)))
+        if self._on_cancel is not None:
+            self._on_cancel()
+        return True
 
     def execute(self, target):
+        # Returns whether the call succeeded, None if it was cancelled, or
+        # the greenlet it runs in, returning that, if it is not serialized.
+        if self.cancelled:
+            return None
+        if self.offload is not None and not self.offload.serialized:
+            return gevent.spawn(self._execute, target)
+        return self._execute(target)
+
+    def _execute(self, target):
+        span = tracing.call_started(target, self) if _tracers else None
+        failure = None
         try:
             function = getattr(target, self.name)
-            self._result.set(function(*self._args, **self._kwargs))
+            if self.offload is None:
+                value = function(*self._args, **self._kwargs)
+            else:
+                value = self.offload.run(function, self._args, self._kwargs)
+            self._resolve(value, None)
+            return True
         except Exception as error:
-            self._result.set_exception(error)
+            failure = error
+            self._resolve(None, error)
+            return False
+        except BaseException as error:
+            # killed or timed out: the span still ends, telling why
+            failure = error
+            raise
+        finally:
+            if span is not None:
+                span.finish(failure)
+
+    def _resolve(self, value, error):
+        # the outcome of a call cancelled while running is discarded
+        if self._done:
+            return
+        self._value = value
+        self._error = error
+        self._done = True
+        if self._waiter is not None:
+            self._waiter.hub.loop.run_callback(self._waiter.switch, None)
+        if self._links:
+            get_hub().loop.run_callback(self._notify_links)
+
+    def _notify_links(self):
+        links, self._links = self._links, None
+        for link in links:
+            link(self)
+
+
+def priority(level):
+    def decorator(function):
+        function.call_priority = level
+        return function
+    return decorator
+
+
+def _call_priority(target, name, override):
+    if override is not None:
+        return override
+    return getattr(getattr(target, name, None), 'call_priority', None)
+
+
+class _Offload(object):
+    def __init__(self, executor, serialized):
+        self.executor = executor
+        self.serialized = serialized
+
+    def run(self, function, args, kwargs):
+        if self.executor is None:
+            return get_hub().threadpool.apply(function, args, kwargs)
+        return _wait_future(self.executor.submit(function, *args, **kwargs))
+
+
+def _wait_future(future):
+    # concurrent.futures callbacks run in the executor's threads: the only
+    # safe way to get back to the hub from there is an async watcher.
+    watcher = get_hub().loop.async_()
+    waiter = Waiter()
+    watcher.start(waiter.switch, None)
+    try:
+        future.add_done_callback(lambda _: watcher.send())
+        waiter.get()
+    finally:
+        watcher.close()
+    return future.result()
+
+
+def offload(function=None, executor=None, serialized=True):
+    def decorator(fun):
+        fun.call_offload = _Offload(executor, serialized)
+        return fun
+
+    if function is None:
+        return decorator
+    else:
+        return decorator(function)
+
+
+def _call_offload(target, name):
+    return getattr(getattr(target, name, None), 'call_offload', None)
 
 
 class _Sync(object):
     class Handle(object):
-        def __init__(self, target, name, timeout):
+        __slots__ = ('_name', '_target', '_timeout', '_priority', '_offload')
+
+        def __init__(self, target, name, timeout, priority):
             self._name = name
             self._target = target
             self._timeout = timeout
+            self._priority = _call_priority(target, name, priority)
+            self._offload = _call_offload(target, name)
 
         def __call__(self, *args, **kwargs):
             event = _SyncCall(self._name, *args, **kwargs)
+            if self._priority is not None:
+                event.priority = self._priority
+            if self._offload is not None:
+                event.offload = self._offload
             self._target.add_request(event)
             return event.wait(self._timeout)
 
-    def __init__(self, target):
+    def __init__(self, target, timeout=None, priority=None, proxies=None):
         self._target = target
-        self._timeout = None
-
-    def __call__(self, timeout=None):
         self._timeout = timeout
-        return self
+        self._priority = priority
+        self._proxies = {} if proxies is None else proxies
+
+    def __call__(self, timeout=None, priority=None):
+        # Configured proxies are never modified once created, so they can
+        # be shared between all the callers asking for the same settings.
+        key = (timeout, priority)
+        proxy = self._proxies.get(key)
+        if proxy is None:
+            proxy = _Sync(self._target, timeout=timeout, priority=priority,
+                          proxies=self._proxies)
+            if len(self._proxies) < _MAX_CACHED_PROXIES:
+                self._proxies[key] = proxy
+        return proxy
 
     def __getattr__(self, name):
-        return self.Handle(self._target, name, self._timeout)
+        # cached in the instance dictionary, so it won't be looked up again
+        handle = self.__dict__[name] = self.Handle(
+            self._target, name, self._timeout, self._priority)
+        return handle
 
 
 class _OnewayCall(object):
+    __slots__ = ('name', '_args', '_kwargs', 'priority', 'offload',
+                 'enqueued_at', 'trace_context')
+
+    cancelled = False
+
     def __init__(self, name, *args, **kwargs):
         self.name = name
         self._args = args
         self._kwargs = kwargs
+        self.offload = None
 
     def execute(self, target):
+        if self.offload is not None and not self.offload.serialized:
+            return gevent.spawn(self._execute, target)
+        return self._execute(target)
+
+    def _execute(self, target):
+        span = tracing.call_started(target, self) if _tracers else None
+        failure = None
         try:
             function = getattr(target, self.name)
-            function(*self._args, **self._kwargs)
+            if self.offload is None:
+                function(*self._args, **self._kwargs)
+            else:
+                self.offload.run(function, self._args, self._kwargs)
         except Exception as error:
+            failure = error
             _LOG.exception("Oneway call of {} on {} "
                            "failed with error: {}".format(self.name,
                                                           target,
                                                           error))
+        except BaseException as error:
+            failure = error
+            raise
+        finally:
+            if span is not None:
+                span.finish(failure)
+        return failure is None
+
+
+class _CoalescedCall(_OnewayCall):
+    __slots__ = ('coalesce_key',)
+
+    def __init__(self, name, key, *args, **kwargs):
+        super(_CoalescedCall, self).__init__(name, *args, **kwargs)
+        self.coalesce_key = key
+
+    def replace(self, args, kwargs):
+        self._args = args
+        self._kwargs = kwargs
+
+    def execute(self, target):
+        target.discard_request(self)
+        return super(_CoalescedCall, self).execute(target)
+
+
+def coalesce(key):
+    def decorator(function):
+        function.coalesce_key = key
+        return function
+    return decorator
 
 
 class _OneWay(object):
     class Handle(object):
-        def __init__(self, target, name):
+        __slots__ = ('_name', '_target', '_coalesce_key', '_priority',
+                     '_offload')
+
+        def __init__(self, target, name, priority):
             self._name = name
             self._target = target
+            self._coalesce_key = getattr(getattr(target, name, None),
+                                         'coalesce_key', None)
+            self._priority = _call_priority(target, name, priority)
+            self._offload = _call_offload(target, name)
 
         def __call__(self, *args, **kwargs):
-            event = _OnewayCall(self._name, *args, **kwargs)
-            self._target.add_request(event)
+            if self._coalesce_key is None:
+                event = _OnewayCall(self._name, *args, **kwargs)
+                add_request = self._target.add_request
+            else:
+                key = (self._name, self._coalesce_key(*args, **kwargs))
+                event = _CoalescedCall(self._name, key, *args, **kwargs)
+                add_request = self._target.add_coalesced_request
+            if self._priority is not None:
+                event.priority = self._priority
+            if self._offload is not None:
+                event.offload = self._offload
+            add_request(event)
 
-    def __init__(self, target):
+    def __init__(self, target, priority=None, proxies=None):
         self._target = target
+        self._priority = priority
+        self._proxies = {} if proxies is None else proxies
 
-    def __call__(self):
-        return self
+    def __call__(self, priority=None):
+        proxy = self._proxies.get(priority)
+        if proxy is None:
+            proxy = type(self)(self._target, priority=priority,
+                               proxies=self._proxies)
+            if len(self._proxies) < _MAX_CACHED_PROXIES:
+                self._proxies[priority] = proxy
+        return proxy
 
     def __getattr__(self, name):
-        return self.Handle(self._target, name)
+        handle = self.__dict__[name] = self.Handle(
+            self._target, name, self._priority)
+        return handle
+
+
+class _Deferred(_OneWay):
+    class Handle(object):
+        __slots__ = ('_name', '_target', '_priority', '_offload')
+
+        def __init__(self, target, name, priority):
+            self._name = name
+            self._target = target
+            self._priority = _call_priority(target, name, priority)
+            self._offload = _call_offload(target, name)
+
+        def __call__(self, *args, **kwargs):
+            event = _SyncCall(self._name, *args, **kwargs)
+            if self._priority is not None:
+                event.priority = self._priority
+            if self._offload is not None:
+                event.offload = self._offload
+            self._target.add_request(event)
+            return event
+
+
+def wait_all(futures, timeout=None):
+    futures = list(futures)
+    pending = [future for future in futures if not future.ready()]
+    if pending and len(gevent.wait(pending, timeout=timeout)) < len(pending):
+        raise Timeout(timeout)
+    return [future.get() for future in futures]
+
+
+def wait_any(futures, timeout=None):
+    ready = gevent.wait(futures, timeout=timeout, count=1)
+    if not ready:
+        raise Timeout(timeout)
+    return ready[0]
+
+
+def _is_cancelled(event):
+    return getattr(event, 'cancelled', False)
+
+
+def _compile_whitelist(whitelist):
+    # the end marker has to get through any whitelist
+    return frozenset(whitelist).union((StopIteration,))
 
 
 class DeferredCallHandler(object):
-    def __init__(self):
-        self._requests = EventQueue()
+    def __init__(self, prioritized=False, starvation_limit=64,
+                 maxsize=None, overflow=OVERFLOW_BLOCK, put_timeout=None,
+                 indexed=False, slicing=None, metrics=None):
+        if prioritized:
+            self._requests = PriorityEventQueue(
+                maxsize, starvation_limit=starvation_limit, indexed=indexed)
+        else:
+            self._requests = EventQueue(maxsize, indexed=indexed)
+        self._overflow = overflow
+        self._put_timeout = put_timeout
+        self.slicing = slicing
+        self._metrics = metrics
+        self.overflow_counts = collections.Counter()
+        self.cancelled_count = 0
+        self._coalesced = {}
+        # set while a whitelist waits on a queue without index, for the
+        # calls it lets through to wake it up
+        self._awaited = None
+        self._arrival = None
         self.sync = _Sync(self)
         self.oneway = _OneWay(self)
+        self.deferred = _Deferred(self)
 
     def add_request(self, request):
-        self._requests.put(request)
+        if _tracers:
+            tracing.call_queued(self, request)
+        if self._metrics is not None:
+            queued = self._add_measured_request(request)
+        elif not self._requests.full():
+            self._requests.put(request)
+            queued = True
+        else:
+            queued = self._overflowed(request)
+        if self._awaited is not None and request.name in self._awaited:
+            self._arrival.set()
+        return queued
+
+    def _add_measured_request(self, request):
+        # stamped beforehand, as a blocked put may only return once the
+        # call has been executed
+        request.enqueued_at = time.time()
+        if not self._requests.full():
+            self._requests.put(request)
+            queued = True
+        else:
+            queued = self._overflowed(request)
+        if queued:
+            self._metrics.enqueued(request.name, self._requests.qsize())
+        return queued
+
+    def _overflowed(self, request):
+        # Calls nobody is waiting for anymore are the first to go
+        cancelled = self._requests.remove_first(_is_cancelled)
+        if cancelled is not None:
+            self._skip(cancelled)
+            self._requests.put_nowait(request)
+            return True
+
+        overflow = self._overflow
+        oneway = isinstance(request, _OnewayCall)
+
+        if overflow == OVERFLOW_BLOCK:
+            self.overflow_counts['blocked'] += 1
+            self._requests.put(request)
+            return True
+
+        if overflow == OVERFLOW_BLOCK_TIMEOUT:
+            self.overflow_counts['blocked'] += 1
+            try:
+                self._requests.put(request, timeout=self._put_timeout)
+                return True
+            except Full:
+                self.overflow_counts['timed_out'] += 1
+                self._count_dropped(request)
+                raise QueueFull("Timed out queueing call to {}".format(
+                    request.name))
+
+        if overflow == OVERFLOW_DROP_OLDEST:
+            oldest = self._requests.remove_first(
+                lambda event: isinstance(event, _OnewayCall))
+            if oldest is not None:
+                self.overflow_counts['dropped_oldest'] += 1
+                self._count_dropped(oldest)
+                self.discard_request(oldest)
+                self._requests.put_nowait(request)
+                return True
+
+        if oneway and overflow in (OVERFLOW_DROP_NEWEST,
+                                   OVERFLOW_DROP_OLDEST):
+            self.overflow_counts['dropped_newest'] += 1
+            self._count_dropped(request)
+            return False
+
+        self.overflow_counts['rejected'] += 1
+        self._count_dropped(request)
+        raise QueueFull("Call queue full, rejected call to {}".format(
+            request.name))
+
+    def _count_dropped(self, request):
+        if self._metrics is not None:
+            self._metrics.dropped(request.name)
+
+    def _skip(self, request):
+        self.cancelled_count += 1
+        if self._metrics is not None:
+            self._metrics.timed_out(request.name)
+
+    def add_coalesced_request(self, request):
+        pending = self._coalesced.get(request.coalesce_key)
+        if pending is not None:
+            pending.replace(request._args, request._kwargs)
+            return True
+        queued = self.add_request(request)
+        if queued:
+            self._coalesced[request.coalesce_key] = request
+        return queued
+
+    def discard_request(self, request):
+        key = getattr(request, 'coalesce_key', None)
+        if key is not None and self._coalesced.get(key) is request:
+            del self._coalesced[key]
 
     def stop_processing(self):
         self._requests.put(StopIteration)
+        if self._arrival is not None:
+            self._arrival.set()
+
+    def process(self, forever=False, whitelist=None,
+                batched=False, max_batch_size=None):
+        if whitelist:
+            names = _compile_whitelist(whitelist)
+        if self.slicing is not None:
+            self.slicing.start()
+        if batched:
+            if whitelist:
+                batches = self._matching_batches(names, forever,
+                                                 max_batch_size)
+            else:
+                batches = self._requests.batches(until_empty=not forever,
+                                                 max_size=max_batch_size)
+            for batch in batches:
+                calls = self._filter_batch(batch)
+                if calls:
+                    self.process_batch(calls)
+                if self.slicing is not None:
+                    self.slicing.step(len(batch), self._requests.qsize())
+            return
 
-    def process(self, forever=False, whitelist=None):
-        for event in self._requests.all(until_empty=not forever):
-            if not whitelist or event.name in whitelist:
+        if whitelist:
+            events = self._matching(names, forever)
+        else:
+            events = self._requests.all(until_empty=not forever)
+        for event in events:
+            if event.cancelled:
+                self._skip(event)
+            elif self._metrics is None:
                 event.execute(self)
+            else:
+                self._execute_measured(event)
+            if self.slicing is not None:
+                self.slicing.step(1, self._requests.qsize())
+
+    def _matching(self, names, forever):
+        # Calls left out by the whitelist stay queued, in order
+        for events in self._matching_runs(names, forever, 1):
+            for event in events:
+                if event is StopIteration:
+                    return
+                yield event
+
+    def _matching_batches(self, names, forever, max_size):
+        for events in self._matching_runs(names, forever, max_size):
+            size = max_size or len(events)
+            for start in xrange(0, len(events), size):
+                batch = events[start:start + size]
+                if batch[-1] is StopIteration:
+                    if len(batch) > 1:
+                        yield batch[:-1]
+                    return
+                yield batch
+
+    def _matching_runs(self, names, forever, max_size):
+        # Yields the calls matching as they get taken, the last ones ending
+        # with the end marker if it is reached.
+        if self._requests.indexed:
+            return self._indexed_runs(names, forever, max_size)
+        return self._scanned_runs(names, forever)
+
+    def _indexed_runs(self, names, forever, max_size):
+        requests = self._requests
+        while True:
+            try:
+                events = [requests.get_matching(*names, block=forever)]
+            except Empty:
+                return
+            while (events[-1] is not StopIteration
+                   and (max_size is None or len(events) < max_size)):
+                try:
+                    events.append(requests.get_matching(*names, block=False))
+                except Empty:
+                    break
+            yield events
+
+    def _scanned_runs(self, names, forever):
+        # Without an index, all the calls matching are taken in a single
+        # pass through the queue, after which only the calls queued since
+        # get gone through.
+        requests = self._requests
+        mark = None
+        while True:
+            events = requests.get_all_matching(*names, since=mark)
+            mark = requests.mark()
+            if events:
+                yield events
+            elif not forever:
+                return
+            else:
+                self._wait_arrival(names)
+
+    def _wait_arrival(self, names):
+        # until a call matching is queued, or the end marker
+        self._awaited = names
+        self._arrival = Event()
+        try:
+            self._arrival.wait()
+        finally:
+            self._awaited = None
+            self._arrival = None
+
+    def _filter_batch(self, batch):
+        accepted = []
+        for event in batch:
+            if event.cancelled:
+                self._skip(event)
+            else:
+                accepted.append(event)
+        return accepted
+
+    def process_batch(self, calls):
+        if self._metrics is None:
+            for call in calls:
+                call.execute(self)
+        else:
+            for call in calls:
+                self._execute_measured(call)
+
+    def _execute_measured(self, call):
+        start = time.time()
+        outcome = call.execute(self)
+        if outcome is None:
+            # cancelled while the calls before it in the batch ran
+            self._skip(call)
+        elif isinstance(outcome, gevent.Greenlet):
+            # the handler moved on straight away: measured once done
+            outcome.link(lambda greenlet: self._measured(
+                call, start, greenlet.value))
+        else:
+            self._measured(call, start, outcome)
+
+    def _measured(self, call, start, succeeded):
+        end = time.time()
+        self._metrics.executed(
+            call.name, start - getattr(call, 'enqueued_at', start),
+            end - start, succeeded is not True, self._requests.qsize())
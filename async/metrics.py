@@ -0,0 +1,177 @@
+import bisect
+
+__author__ = 'ocarrere'
+
+# In seconds, for both the time calls wait in the queue and the time they
+# take to execute.
+DEFAULT_BUCKETS = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1., 5.)
+
+
+class MetricsSink(object):
+    # Receives the events of the handlers it is given to. Calls are told
+    # apart by method name; depth is the number of calls queued on the
+    # handler at the time of the event.
+
+    def enqueued(self, name, depth):
+        pass
+
+    def dropped(self, name):
+        # the call never made it to the queue, or was evicted from it
+        pass
+
+    def timed_out(self, name):
+        # the call was skipped since its caller stopped waiting for it
+        pass
+
+    def executed(self, name, wait, duration, failed, depth):
+        pass
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, number of values up to it), the last bound being
+        # infinite
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class MethodMetrics(object):
+    __slots__ = ('enqueued', 'executed', 'failed', 'timed_out', 'dropped',
+                 'wait', 'duration')
+
+    def __init__(self, buckets):
+        self.enqueued = 0
+        self.executed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.dropped = 0
+        self.wait = Histogram(buckets)
+        self.duration = Histogram(buckets)
+
+
+class MetricsAggregator(MetricsSink):
+    # Keeps the counters and histograms of each method in memory.
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self.methods = {}
+        self.depth = 0
+        self.max_depth = 0
+
+    def method(self, name):
+        metrics = self.methods.get(name)
+        if metrics is None:
+            metrics = self.methods[name] = MethodMetrics(self._buckets)
+        return metrics
+
+    def _set_depth(self, depth):
+        self.depth = depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def enqueued(self, name, depth):
+        self.method(name).enqueued += 1
+        self._set_depth(depth)
+
+    def dropped(self, name):
+        self.method(name).dropped += 1
+
+    def timed_out(self, name):
+        self.method(name).timed_out += 1
+
+    def executed(self, name, wait, duration, failed, depth):
+        metrics = self.method(name)
+        metrics.executed += 1
+        if failed:
+            metrics.failed += 1
+        metrics.wait.observe(wait)
+        metrics.duration.observe(duration)
+        self._set_depth(depth)
+
+
+_COUNTERS = [
+    ('enqueued', 'Calls queued on the handler.'),
+    ('executed', 'Calls executed by the handler.'),
+    ('failed', 'Calls which raised an exception.'),
+    ('timed_out', 'Calls skipped since their caller stopped waiting.'),
+    ('dropped', 'Calls dropped or rejected by a full queue.'),
+]
+
+_HISTOGRAMS = [
+    ('wait', 'call_wait_seconds',
+     'Time calls spent queued before being executed.'),
+    ('duration', 'call_duration_seconds', 'Time calls took to execute.'),
+]
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+
+def prometheus_text(aggregators, prefix='async'):
+    # Formats the metrics of aggregators, given by handler name, in the
+    # Prometheus text exposition format.
+    handlers = sorted(aggregators.items())
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+
+    for attribute, help_text in _COUNTERS:
+        name = 'calls_{}_total'.format(attribute)
+        family(name, 'counter', help_text)
+        for handler, aggregator in handlers:
+            for method, metrics in sorted(aggregator.methods.items()):
+                lines.append('{}_{}{} {}'.format(
+                    prefix, name, _labels(handler=handler, method=method),
+                    getattr(metrics, attribute)))
+
+    for attribute, help_text in [('depth', 'Calls currently queued.'),
+                                 ('max_depth', 'Most calls ever queued.')]:
+        name = 'queue_{}'.format(attribute)
+        family(name, 'gauge', help_text)
+        for handler, aggregator in handlers:
+            lines.append('{}_{}{} {}'.format(
+                prefix, name, _labels(handler=handler),
+                getattr(aggregator, attribute)))
+
+    for attribute, name, help_text in _HISTOGRAMS:
+        family(name, 'histogram', help_text)
+        for handler, aggregator in handlers:
+            for method, metrics in sorted(aggregator.methods.items()):
+                histogram = getattr(metrics, attribute)
+                for bound, count in histogram.cumulative():
+                    lines.append('{}_{}_bucket{} {}'.format(
+                        prefix, name, _labels(handler=handler, method=method,
+                                              le=_bound(bound)), count))
+                labels = _labels(handler=handler, method=method)
+                lines.append('{}_{}_sum{} {!r}'.format(
+                    prefix, name, labels, histogram.sum))
+                lines.append('{}_{}_count{} {}'.format(
+                    prefix, name, labels, histogram.count))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,68 @@
+import itertools
+from gevent.pool import Group
+
+__author__ = 'ocarrere'
+
+
+class _Handle(object):
+    __slots__ = ('_pool', '_kind', '_config', '_name')
+
+    def __init__(self, pool, kind, config, name):
+        self._pool = pool
+        self._kind = kind
+        self._config = config
+        self._name = name
+
+    def __call__(self, *args, **kwargs):
+        proxy = getattr(self._pool.shard(*args, **kwargs), self._kind)
+        if self._config:
+            proxy = proxy(**self._config)
+        return getattr(proxy, self._name)(*args, **kwargs)
+
+
+class _Proxy(object):
+    def __init__(self, pool, kind, **config):
+        self._pool = pool
+        self._kind = kind
+        self._config = config
+
+    def __call__(self, **config):
+        return _Proxy(self._pool, self._kind, **config)
+
+    def __getattr__(self, name):
+        handle = self.__dict__[name] = _Handle(self._pool, self._kind,
+                                               self._config, name)
+        return handle
+
+
+class _Sharded(object):
+    def __init__(self, handlers, key):
+        self.handlers = handlers
+        self._key = key
+        self._round_robin = itertools.cycle(handlers)
+        self.sync = _Proxy(self, 'sync')
+        self.oneway = _Proxy(self, 'oneway')
+        self.deferred = _Proxy(self, 'deferred')
+
+    def shard(self, *args, **kwargs):
+        if self._key is None:
+            return next(self._round_robin)
+        key = self._key(*args, **kwargs)
+        return self.handlers[hash(key) % len(self.handlers)]
+
+
+class HandlerPool(_Sharded):
+    def __init__(self, factory, size, key):
+        super(HandlerPool, self).__init__(
+            [factory() for _ in xrange(size)], key)
+        self._processors = Group()
+
+    def start(self, **process_options):
+        for handler in self.handlers:
+            self._processors.spawn(handler.process, forever=True,
+                                   **process_options)
+
+    def stop(self, timeout=None):
+        for handler in self.handlers:
+            handler.stop_processing()
+        self._processors.join(timeout=timeout)
@@ -0,0 +1,82 @@
+import errno
+import fcntl
+import os
+import gevent
+from gevent import socket
+from gevent.os import waitpid
+from logging import getLogger
+from .pool import _Sharded
+from .remote import RemoteTarget, serve
+
+__author__ = 'ocarrere'
+
+_LOG = getLogger(__name__)
+
+
+class _Pipe(object):
+    # Plain blocking I/O for the worker's end of the connection, so that
+    # serving calls never goes through the hub inherited from the parent.
+
+    def __init__(self, connection):
+        self._fd = os.dup(connection.fileno())
+        flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+
+    def recv(self, size):
+        while True:
+            try:
+                return os.read(self._fd, size)
+            except OSError as error:
+                if error.errno != errno.EINTR:
+                    raise
+
+    def sendall(self, data):
+        while data:
+            try:
+                data = data[os.write(self._fd, data):]
+            except OSError as error:
+                if error.errno != errno.EINTR:
+                    raise
+
+
+def _leave_parent(siblings):
+    # The worker inherits the parent's greenlets, such as the readers of
+    # the workers forked before it, which would run whenever the handler
+    # yields to the hub and take the replies meant for the parent. Their
+    # connections are closed, and the hub is replaced with a clean one.
+    for sibling in siblings:
+        sibling._connection.close()
+    gevent.get_hub().destroy(destroy_loop=True)
+
+
+class _Worker(RemoteTarget):
+    def __init__(self, factory, siblings=()):
+        connection, worker_connection = socket.socketpair()
+        self.pid = gevent.fork()
+        if self.pid == 0:
+            try:
+                connection.close()
+                _leave_parent(siblings)
+                serve(_Pipe(worker_connection), factory())
+            except BaseException:
+                _LOG.exception("Worker process failed")
+            finally:
+                os._exit(0)
+        worker_connection.close()
+        super(_Worker, self).__init__(connection)
+
+    def close(self):
+        super(_Worker, self).close()
+        waitpid(self.pid, 0)
+
+
+class ProcessHandlerPool(_Sharded):
+    def __init__(self, factory, size=1, key=None):
+        workers = []
+        for _ in xrange(size):
+            workers.append(_Worker(factory, workers))
+        super(ProcessHandlerPool, self).__init__(workers, key)
+
+    def close(self):
+        for worker in self.handlers:
+            worker.close()
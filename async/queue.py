@@ -1,22 +1,532 @@
-from gevent.queue import Queue
+import collections
+import itertools
+import gevent.event
+from gevent import Timeout
+from gevent.queue import Queue, Empty
 
 __author__ = 'ocarrere'
 
+LOW_PRIORITY = -1
+NORMAL_PRIORITY = 0
+HIGH_PRIORITY = 1
+
+# The end marker is served once every call queued before it has been, so it
+# gets a lane below all the others, which is never promoted for starving.
+_END_PRIORITY = float('-inf')
+
 
 class Event(object):
     def __init__(self, name, data=None):
         self._name = name
         self._data = data
 
+    @property
+    def name(self):
+        return self._name
+
     def match(self, *args):
         return self._name in args
 
 
 class EventQueue(Queue):
+    def __init__(self, maxsize=None, items=(), indexed=False):
+        self._indexed = indexed
+        super(EventQueue, self).__init__(maxsize, items)
+
+    def _create_queue(self, items=()):
+        return self._wrap(_Fifo(items))
+
+    def _wrap(self, container):
+        if self._indexed:
+            return _Index(container)
+        return container
+
+    @property
+    def indexed(self):
+        return self._indexed
+
+    def _peek(self):
+        return self.queue.peek()
+
     def all(self, timeout=None, until_empty=False):
         while not until_empty or not self.empty():
             event = self.get(timeout=timeout)
             if event == StopIteration:
                 return
             yield event
-            event.handled = False
+
+    def remove_first(self, predicate):
+        return self.queue.remove_first(predicate)
+
+    def get_matching(self, *names, **options):
+        # Selective receive: takes the oldest event matching one of the
+        # names, leaving the others queued in order. Without an index, the
+        # queue is scanned in the order it is served, which doesn't allow
+        # waiting for a match.
+        block = options.pop('block', True)
+        timeout = options.pop('timeout', None)
+        if options:
+            raise TypeError("Unexpected options {}".format(sorted(options)))
+        if not self._indexed:
+            if block:
+                raise ValueError("Waiting for a match requires an indexed "
+                                 "queue")
+            if self.queue.select(lambda item: _index_key(item) in names):
+                return self.get(False)
+            raise Empty
+        index = self.queue
+        # goes through get() so that blocked putters of a bounded queue get
+        # woken up
+        if index.select(names):
+            return self.get(False)
+        if not block:
+            raise Empty
+        index.waiters += 1
+        try:
+            with Timeout(timeout, Empty):
+                while True:
+                    index.arrival.clear()
+                    if index.select(names):
+                        return self.get(False)
+                    index.arrival.wait()
+        finally:
+            index.waiters -= 1
+
+    def mark(self):
+        # Identifies the events queued so far, for get_all_matching to only
+        # go through the ones queued since.
+        if self._indexed:
+            return None
+        return self.queue.mark()
+
+    def get_all_matching(self, *names, **options):
+        # Takes every event matching one of the names at once, in the order
+        # they are served and up to the end marker, leaving the others
+        # queued in order. Without an index, this goes through the queue
+        # once however many events match, or only through the events queued
+        # since a mark.
+        since = options.pop('since', None)
+        if options:
+            raise TypeError("Unexpected options {}".format(sorted(options)))
+        if self._indexed:
+            events = []
+            while self.queue.select(names):
+                events.append(self.get(False))
+                if events[-1] is StopIteration:
+                    break
+            return events
+        ended = []
+
+        def matches(item):
+            if ended or _index_key(item) not in names:
+                return False
+            if item is StopIteration:
+                ended.append(item)
+            return True
+        events = self.queue.remove_all(matches, since)
+        if events:
+            # the first one goes back through get(), so that blocked
+            # putters of a bounded queue get woken up
+            self.queue.appendleft(events[0])
+            events[0] = self.get(False)
+        return events
+
+    def get_batch(self, timeout=None, max_size=None):
+        # Waits for a first event, then takes whatever else is already
+        # pending in one go, without going back through the hub.
+        batch = [self.get(timeout=timeout)]
+        if batch[0] is StopIteration:
+            return batch
+        pending = self.qsize()
+        if max_size is not None:
+            pending = min(pending, max_size - 1)
+        for index in xrange(pending):
+            # the last one goes through get() so that blocked putters of
+            # a bounded queue get woken up
+            event = self._get() if index < pending - 1 else self.get(False)
+            batch.append(event)
+            if event is StopIteration:
+                break
+        return batch
+
+    def batches(self, timeout=None, until_empty=False, max_size=None):
+        while not until_empty or not self.empty():
+            batch = self.get_batch(timeout=timeout, max_size=max_size)
+            if batch[-1] is StopIteration:
+                if len(batch) > 1:
+                    yield batch[:-1]
+                return
+            yield batch
+
+
+class _Fifo(collections.deque):
+    __slots__ = ()
+    priorities = (None,)
+
+    def peek(self):
+        return self[0]
+
+    def priority(self, item):
+        return None
+
+    def choose(self, priorities):
+        return None
+
+    def remove_first(self, predicate):
+        for index, item in enumerate(self):
+            if predicate(item):
+                del self[index]
+                return item
+        return None
+
+    def remove_all(self, predicate, since=None):
+        return _remove_all(self, predicate, since)
+
+    def mark(self):
+        return self[-1] if self else None
+
+    def select(self, predicate):
+        # Moves the first item matching to the head, for popleft to take
+        for index, item in enumerate(self):
+            if predicate(item):
+                if index:
+                    del self[index]
+                    self.appendleft(item)
+                return True
+        return False
+
+
+def _remove_all(items, predicate, since=None):
+    # Removes the items matching from a deque and returns them, in order.
+    # Given the last item queued at some point, only the ones queued after
+    # it are gone through, unless it left the deque since.
+    if since is None:
+        newer = list(items)
+        items.clear()
+    else:
+        newer = []
+        while items and items[-1] is not since:
+            newer.append(items.pop())
+        newer.reverse()
+    removed = []
+    for item in newer:
+        if predicate(item):
+            removed.append(item)
+        else:
+            items.append(item)
+    return removed
+
+
+def _index_key(item):
+    # events and calls are indexed by name, anything else by itself
+    return getattr(item, 'name', item)
+
+
+def _discard(counter, key):
+    counter[key] -= 1
+    if not counter[key]:
+        del counter[key]
+
+
+def _consume(counter, key):
+    if key not in counter:
+        return False
+    _discard(counter, key)
+    return True
+
+
+# Wraps a queue's container with an index of its items by name and priority,
+# so that the next item matching some names, in the order the container
+# serves them, can be taken out of order. Such items are left behind in the
+# container, and skipped once they reach its head. The other way around,
+# index entries of items which left the container from elsewhere than the
+# head of their lane are skipped once they reach it. Both get compacted away
+# once they outnumber the items queued.
+class _Index(object):
+    def __init__(self, items):
+        self._items = items
+        self._lanes = {}
+        self._sequence = itertools.count()
+        self._taken = collections.Counter()
+        self._stale = collections.Counter()
+        self._garbage = 0
+        self._selected = None
+        self._length = 0
+        self.arrival = gevent.event.Event()
+        self.waiters = 0
+        for item in items:
+            self._add(item)
+
+    def _key(self, item):
+        return _index_key(item), self._items.priority(item)
+
+    def _add(self, item):
+        key = self._key(item)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = collections.deque()
+        lane.append((next(self._sequence), item))
+        self._length += 1
+
+    def _advance(self, key, lane):
+        lane.popleft()
+        while lane and id(lane[0][1]) in self._stale:
+            _discard(self._stale, id(lane.popleft()[1]))
+            self._garbage -= 1
+        if not lane:
+            del self._lanes[key]
+
+    def _remove(self, item):
+        self._length -= 1
+        key = self._key(item)
+        lane = self._lanes[key]
+        if lane[0][1] is item:
+            self._advance(key, lane)
+        else:
+            self._stale[id(item)] += 1
+            self._add_garbage()
+
+    def _skip_taken(self):
+        while self._taken and id(self._items.peek()) in self._taken:
+            _discard(self._taken, id(self._items.popleft()))
+            self._garbage -= 1
+
+    def _add_garbage(self):
+        self._garbage += 1
+        if self._garbage > self._length:
+            self._compact()
+
+    def _compact(self):
+        # Costs as much as the items queued, which at least as many
+        # removals made necessary.
+        taken = self._taken
+        self._items.remove_all(lambda item: _consume(taken, id(item)))
+        stale = self._stale
+        for key, lane in self._lanes.items():
+            entries = [entry for entry in lane
+                       if not _consume(stale, id(entry[1]))]
+            if entries:
+                self._lanes[key] = collections.deque(entries)
+            else:
+                del self._lanes[key]
+        self._garbage = 0
+
+    def select(self, names):
+        # Picks the item matching the names to pop next: the oldest of those
+        # in the priority the container serves first.
+        candidates = {}
+        for priority in self._items.priorities:
+            for name in names:
+                lane = self._lanes.get((name, priority))
+                if lane is not None and (
+                        priority not in candidates
+                        or lane[0][0] < candidates[priority][0][0]):
+                    candidates[priority] = lane
+        if not candidates:
+            self._selected = None
+            return False
+        self._selected = candidates[self._items.choose(candidates)]
+        return True
+
+    def append(self, item):
+        self._items.append(item)
+        self._add(item)
+        if self.waiters:
+            self.arrival.set()
+
+    def popleft(self):
+        lane, self._selected = self._selected, None
+        if lane is not None:
+            item = lane[0][1]
+            self._advance(self._key(item), lane)
+            self._taken[id(item)] += 1
+            self._length -= 1
+            self._add_garbage()
+            return item
+        self._skip_taken()
+        item = self._items.popleft()
+        self._remove(item)
+        return item
+
+    def peek(self):
+        self._skip_taken()
+        return self._items.peek()
+
+    def remove_first(self, predicate):
+        # Only the first copies of an item, up to the number taken, are
+        # tombstones: later ones are still queued.
+        taken = collections.Counter(self._taken)
+
+        def matches(item):
+            if taken[id(item)]:
+                taken[id(item)] -= 1
+                return False
+            return predicate(item)
+        item = self._items.remove_first(matches)
+        if item is not None:
+            self._remove(item)
+        return item
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        taken = collections.Counter(self._taken)
+        for item in self._items:
+            if taken[id(item)]:
+                taken[id(item)] -= 1
+            else:
+                yield item
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, list(self))
+
+
+# FIFO lanes served from the highest priority down. A non-empty lane that
+# has been passed over ``starvation_limit`` times in a row gets served next
+# regardless of the higher lanes.
+class _Lanes(object):
+    def __init__(self, items=(), starvation_limit=None,
+                 default_priority=NORMAL_PRIORITY):
+        self._lanes = {}
+        self._skipped = {}
+        self._priorities = []
+        self._length = 0
+        # the lane of the item select() moved to its head, served next
+        self._selected = None
+        self._starvation_limit = starvation_limit
+        self._default_priority = default_priority
+        for item in items:
+            self.append(item)
+
+    def _lane(self, priority):
+        lane = self._lanes.get(priority)
+        if lane is None:
+            lane = self._lanes[priority] = collections.deque()
+            self._skipped[priority] = 0
+            self._priorities.append(priority)
+            self._priorities.sort(reverse=True)
+        return lane
+
+    @property
+    def priorities(self):
+        return self._priorities
+
+    def _select(self, update, candidates=None):
+        # Picks the priority to serve next among the non-empty lanes, or
+        # among the candidates given.
+        selected = None
+        for priority in self._priorities:
+            if candidates is None:
+                if not self._lanes[priority]:
+                    continue
+            elif priority not in candidates:
+                continue
+            if selected is None:
+                selected = priority
+            elif (self._starvation_limit is not None
+                    and priority != _END_PRIORITY
+                    and self._skipped[priority] >= self._starvation_limit):
+                selected = priority
+                break
+            elif update:
+                self._skipped[priority] += 1
+        if selected is None:
+            raise IndexError("pop from an empty queue")
+        if update:
+            self._skipped[selected] = 0
+        return selected
+
+    def priority(self, item):
+        if item is StopIteration:
+            return _END_PRIORITY
+        return getattr(item, 'priority', self._default_priority)
+
+    def choose(self, priorities):
+        # served as if the lanes of the other priorities were empty
+        return self._select(True, priorities)
+
+    def append(self, item):
+        self._lane(self.priority(item)).append(item)
+        self._length += 1
+
+    def appendleft(self, item):
+        # served next, whatever its priority
+        self._selected = self._lane(self.priority(item))
+        self._selected.appendleft(item)
+        self._length += 1
+
+    def popleft(self):
+        if self._selected is None:
+            lane = self._lanes[self._select(update=True)]
+        else:
+            lane, self._selected = self._selected, None
+        item = lane.popleft()
+        self._length -= 1
+        return item
+
+    def peek(self):
+        if self._selected is not None:
+            return self._selected[0]
+        return self._lanes[self._select(update=False)][0]
+
+    def select(self, predicate):
+        # Moves the first item matching, in the order the lanes are
+        # served, to the head of its lane for popleft to take.
+        for priority in self._priorities:
+            lane = self._lanes[priority]
+            for index, item in enumerate(lane):
+                if predicate(item):
+                    if index:
+                        del lane[index]
+                        lane.appendleft(item)
+                    self._selected = lane
+                    return True
+        return False
+
+    def remove_first(self, predicate):
+        # lowest priorities go first
+        for priority in reversed(self._priorities):
+            lane = self._lanes[priority]
+            for index, item in enumerate(lane):
+                if predicate(item):
+                    del lane[index]
+                    self._length -= 1
+                    return item
+        return None
+
+    def remove_all(self, predicate, since=None):
+        removed = []
+        for priority in self._priorities:
+            lane = self._lanes[priority]
+            length = len(lane)
+            removed.extend(_remove_all(
+                lane, predicate, since and since.get(priority)))
+            self._length -= length - len(lane)
+        return removed
+
+    def mark(self):
+        return dict((priority, lane[-1])
+                    for priority, lane in self._lanes.items() if lane)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for priority in self._priorities:
+            for item in self._lanes[priority]:
+                yield item
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, list(self))
+
+
+class PriorityEventQueue(EventQueue):
+    def __init__(self, maxsize=None, items=(), starvation_limit=64,
+                 indexed=False):
+        self._starvation_limit = starvation_limit
+        super(PriorityEventQueue, self).__init__(maxsize, items, indexed)
+
+    def _create_queue(self, items=()):
+        return self._wrap(
+            _Lanes(items, starvation_limit=self._starvation_limit))
@@ -0,0 +1,265 @@
+import functools
+import itertools
+import json
+import struct
+import cPickle as pickle
+import gevent
+from gevent import socket
+from gevent.lock import Semaphore
+from logging import getLogger
+from .call import _Sync, _OneWay, _Deferred, _SyncCall, _OnewayCall
+
+__author__ = 'ocarrere'
+
+_LOG = getLogger(__name__)
+
+# Every frame is made of its length, followed by an envelope which can
+# always be decoded (the request id and a flag), then by a serialized body.
+_HEADER = struct.Struct('!I')
+_ENVELOPE = struct.Struct('!QB')
+
+_SYNC, _ONEWAY, _CANCEL = 0, 1, 2
+_FAILURE, _SUCCESS = 0, 1
+
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class RemoteError(Exception):
+    pass
+
+
+class Serializer(object):
+    # Serializers which can't carry exceptions as they are send their type
+    # name and message, which get raised back as a RemoteError.
+
+    def dumps(self, value):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+    def dump_error(self, error):
+        return self.dumps([type(error).__name__, str(error)])
+
+    def load_error(self, data):
+        name, message = self.loads(data)
+        return RemoteError("{}: {}".format(name, message))
+
+
+class PickleSerializer(Serializer):
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+    def dump_error(self, error):
+        return self.dumps(error)
+
+    def load_error(self, data):
+        return self.loads(data)
+
+
+class JsonSerializer(Serializer):
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackSerializer(Serializer):
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack serializer requires msgpack")
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer,
+    'json': JsonSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+
+def get_serializer(serializer):
+    if serializer is None:
+        return PickleSerializer()
+    if isinstance(serializer, basestring):
+        return SERIALIZERS[serializer]()
+    return serializer
+
+
+def send_frame(connection, request_id, flag, body):
+    connection.sendall(
+        _HEADER.pack(_ENVELOPE.size + len(body))
+        + _ENVELOPE.pack(request_id, flag) + body)
+
+
+def _receive_exactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def receive_frame(connection):
+    header = _receive_exactly(connection, _HEADER.size)
+    if header is None:
+        return None
+    frame = _receive_exactly(connection, _HEADER.unpack(header)[0])
+    if frame is None:
+        return None
+    request_id, flag = _ENVELOPE.unpack_from(frame)
+    return request_id, flag, frame[_ENVELOPE.size:]
+
+
+def marshal_outcome(call, serializer):
+    try:
+        if call.successful():
+            return _SUCCESS, serializer.dumps(call.get())
+        return _FAILURE, serializer.dump_error(call.exception)
+    except Exception as error:
+        return _FAILURE, serializer.dump_error(RemoteError(
+            "Could not marshal the outcome of {}: {!r}".format(
+                call.name, error)))
+
+
+def unmarshal_call(connection, frame, serializer):
+    # Returns the call carried by a frame, or None if it could not be
+    # unmarshalled, in which case the caller has been told so.
+    request_id, flag, body = frame
+    try:
+        name, args, kwargs = serializer.loads(body)
+    except Exception as error:
+        _LOG.exception("Could not unmarshal call {}".format(request_id))
+        if flag == _SYNC:
+            send_frame(connection, request_id, _FAILURE,
+                       serializer.dump_error(RemoteError(
+                           "Could not unmarshal call: {!r}".format(error))))
+        return None
+    if flag == _ONEWAY:
+        return _OnewayCall(name, *args, **kwargs)
+    return _SyncCall(name, *args, **kwargs)
+
+
+def serve(connection, handler, serializer=None):
+    # Processes the calls received on the connection one at a time, until
+    # it gets closed.
+    serializer = get_serializer(serializer)
+    while True:
+        frame = receive_frame(connection)
+        if frame is None:
+            return
+        if frame[1] == _CANCEL:
+            # calls are processed as they are read, there is nothing
+            # left to cancel
+            continue
+        call = unmarshal_call(connection, frame, serializer)
+        if call is None:
+            continue
+        call.execute(handler)
+        if isinstance(call, _SyncCall):
+            success, outcome = marshal_outcome(call, serializer)
+            send_frame(connection, frame[0], success, outcome)
+
+
+class RemoteTarget(object):
+    # Stands in for a handler living at the other end of a connection:
+    # the calls made through its proxies are forwarded to it, and their
+    # outcome is given back to the waiting callers.
+
+    def __init__(self, connection, serializer=None):
+        self._connection = connection
+        self._serializer = get_serializer(serializer)
+        self._pending = {}
+        self._request_ids = itertools.count()
+        self._write_lock = Semaphore()
+        self.sync = _Sync(self)
+        self.oneway = _OneWay(self)
+        self.deferred = _Deferred(self)
+        self._reader = gevent.spawn(self._read)
+
+    def add_request(self, request):
+        if self._reader.ready():
+            raise RemoteError("Connection closed")
+        request_id = next(self._request_ids)
+        body = self._serializer.dumps(
+            (request.name, request._args, request._kwargs))
+        if isinstance(request, _OnewayCall):
+            flag = _ONEWAY
+        else:
+            flag = _SYNC
+            self._pending[request_id] = request
+            request._on_cancel = functools.partial(self._cancel, request_id)
+        try:
+            with self._write_lock:
+                send_frame(self._connection, request_id, flag, body)
+        except socket.error as error:
+            self._pending.pop(request_id, None)
+            raise RemoteError("Connection failed: {}".format(error))
+        return True
+
+    def _cancel(self, request_id):
+        # Tells the other end to skip the call, or to discard its outcome
+        # if it is already running. Called from the waiting greenlet, which
+        # may be unwinding, hence the write happening elsewhere.
+        if self._pending.pop(request_id, None) is not None:
+            gevent.spawn(self._send_cancel, request_id)
+
+    def _send_cancel(self, request_id):
+        try:
+            with self._write_lock:
+                send_frame(self._connection, request_id, _CANCEL, '')
+        except socket.error as error:
+            _LOG.debug("Could not cancel call {}: {}".format(
+                request_id, error))
+
+    def _read(self):
+        try:
+            while True:
+                frame = receive_frame(self._connection)
+                if frame is None:
+                    break
+                request_id, success, body = frame
+                call = self._pending.pop(request_id, None)
+                if call is None:
+                    continue
+                try:
+                    if success == _SUCCESS:
+                        call._resolve(self._serializer.loads(body), None)
+                    else:
+                        call._resolve(None, self._serializer.load_error(body))
+                except Exception as error:
+                    call._resolve(None, RemoteError(
+                        "Could not unmarshal the outcome of {}: {!r}".format(
+                            call.name, error)))
+        except socket.error as error:
+            _LOG.debug("Connection failed: {}".format(error))
+        finally:
+            pending, self._pending = self._pending, {}
+            for call in pending.itervalues():
+                call._resolve(None, RemoteError("Connection closed"))
+
+    def close(self):
+        # The other end is left to answer the calls already sent before it
+        # closes the connection in turn.
+        try:
+            self._connection.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self._reader.join()
+        self._connection.close()
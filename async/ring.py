@@ -0,0 +1,187 @@
+import errno
+import marshal
+import mmap
+import os
+import struct
+import gevent
+from gevent.socket import wait_read, timeout as socket_timeout
+from logging import getLogger
+from .call import _OneWay, _OnewayCall
+
+__author__ = 'ocarrere'
+
+_LOG = getLogger(__name__)
+
+# The shared file starts with the ring's bookkeeping, each counter on its
+# own cache line. head and tail only ever grow: their difference is the
+# amount of data pending in the ring.
+_COUNTER = struct.Struct('<Q')
+_HEAD = 0
+_TAIL = 64
+_WAITING = 128
+_CAPACITY = 192
+_DATA = 256
+
+# Each call is laid out as the size of its name and of its marshalled
+# parameters, followed by both.
+_RECORD = struct.Struct('<HI')
+
+
+def _wake_path(path):
+    return path + '.wake'
+
+
+def _open_wake_pipe(path):
+    # Opening a fifo read-write never blocks on linux, whichever end we are
+    return os.open(_wake_path(path), os.O_RDWR | os.O_NONBLOCK)
+
+
+class _Ring(object):
+    def __init__(self, path, capacity=None):
+        if capacity is not None:
+            with open(path, 'wb') as ring_file:
+                ring_file.truncate(_DATA + capacity)
+            if os.path.exists(_wake_path(path)):
+                os.unlink(_wake_path(path))
+            os.mkfifo(_wake_path(path))
+        with open(path, 'r+b') as ring_file:
+            self._map = mmap.mmap(ring_file.fileno(), 0)
+        if capacity is not None:
+            self._set(_CAPACITY, capacity)
+        self.capacity = self._get(_CAPACITY)
+        self.wake_fd = _open_wake_pipe(path)
+
+    def _get(self, offset):
+        return _COUNTER.unpack_from(self._map, offset)[0]
+
+    def _set(self, offset, value):
+        _COUNTER.pack_into(self._map, offset, value)
+
+    def _write(self, position, data):
+        start = position % self.capacity
+        end = start + len(data)
+        if end <= self.capacity:
+            self._map[_DATA + start:_DATA + end] = data
+        else:
+            split = self.capacity - start
+            self._map[_DATA + start:_DATA + self.capacity] = data[:split]
+            self._map[_DATA:_DATA + end - self.capacity] = data[split:]
+
+    def _read(self, position, size):
+        start = position % self.capacity
+        end = start + size
+        if end <= self.capacity:
+            return self._map[_DATA + start:_DATA + end]
+        return (self._map[_DATA + start:_DATA + self.capacity]
+                + self._map[_DATA:_DATA + end - self.capacity])
+
+    def close(self):
+        os.close(self.wake_fd)
+        self._map.close()
+
+
+class RingProducer(_Ring):
+    # Writing end of the ring, to be used by a single greenlet of a single
+    # process. Only oneway calls can go through a ring.
+
+    def __init__(self, path):
+        super(RingProducer, self).__init__(path)
+        self._tail = self._get(_TAIL)
+        self.dropped = 0
+        self.oneway = _OneWay(self)
+
+    def add_request(self, request):
+        if not isinstance(request, _OnewayCall):
+            raise TypeError("Only oneway calls can go through a ring")
+        name = request.name
+        parameters = marshal.dumps((request._args, request._kwargs))
+        record = _RECORD.pack(len(name), len(parameters)) + name + parameters
+        if self._tail + len(record) - self._get(_HEAD) > self.capacity:
+            self.dropped += 1
+            return False
+        self._write(self._tail, record)
+        self._tail += len(record)
+        # the record has to be in place before it gets published
+        self._set(_TAIL, self._tail)
+        if self._get(_WAITING):
+            # The consumer only needs waking up once per burst
+            self._set(_WAITING, 0)
+            try:
+                os.write(self.wake_fd, b'!')
+            except OSError as error:
+                if error.errno != errno.EAGAIN:
+                    raise
+        return True
+
+
+class RingConsumer(_Ring):
+    # Reading end of the ring, which creates it. The calls read are queued
+    # on the handler, which keeps being processed as usual by its owner.
+
+    def __init__(self, path, handler, capacity=1 << 20, poll_interval=.1):
+        super(RingConsumer, self).__init__(path, capacity)
+        self._handler = handler
+        self._head = 0
+        # Bounds the delay of a wake-up lost to the ring's counters being
+        # observed out of order by the other process.
+        self._poll_interval = poll_interval
+        self._reader = None
+        self.dropped = 0
+
+    def start(self):
+        self._reader = gevent.spawn(self._run)
+
+    def stop(self):
+        self._reader.kill()
+        self.close()
+
+    def drain(self):
+        tail = self._get(_TAIL)
+        count = 0
+        try:
+            while self._head < tail:
+                name_size, parameters_size = _RECORD.unpack(
+                    self._read(self._head, _RECORD.size))
+                position = self._head + _RECORD.size
+                name = self._read(position, name_size)
+                parameters = self._read(position + name_size,
+                                        parameters_size)
+                self._head = position + name_size + parameters_size
+                count += 1
+                try:
+                    args, kwargs = marshal.loads(parameters)
+                    self._handler.add_request(
+                        _OnewayCall(name, *args, **kwargs))
+                except Exception:
+                    # a call that cannot be queued (e.g. on a full handler)
+                    # is lost, but not the ones behind it
+                    self.dropped += 1
+                    _LOG.exception("Dropped call of {} read from the "
+                                   "ring".format(name))
+        finally:
+            # frees the space for the producer once the whole burst is read
+            self._set(_HEAD, self._head)
+        return count
+
+    def _run(self):
+        while True:
+            if self.drain():
+                # let the handler get to the calls before reading more
+                gevent.sleep()
+                continue
+            self._set(_WAITING, 1)
+            if self._get(_TAIL) == self._head:
+                try:
+                    wait_read(self.wake_fd, timeout=self._poll_interval)
+                except socket_timeout:
+                    pass
+                self._flush_wake_pipe()
+            self._set(_WAITING, 0)
+
+    def _flush_wake_pipe(self):
+        try:
+            while os.read(self.wake_fd, 4096):
+                pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
@@ -0,0 +1,84 @@
+import time
+import gevent
+
+__author__ = 'ocarrere'
+
+
+class SlicePolicy(object):
+    # Makes a processing loop yield to the other greenlets once it has gone
+    # through max_items calls or spent max_time seconds since it last did.
+    # A loop about to wait on an empty queue yields anyway, which starts a
+    # new slice.
+    #
+    # lag is how long the loop waited to be resumed after yielding, which
+    # is how long the other greenlets kept the hub.
+
+    def __init__(self, max_items=None, max_time=None):
+        self.max_items = max_items
+        self.max_time = max_time
+        self.slices = 0
+        self.yields = 0
+        self.items = 0
+        self.max_slice_items = 0
+        self.max_slice_time = 0.
+        self.total_slice_time = 0.
+        self.lag = 0.
+        self.max_lag = 0.
+        self.total_lag = 0.
+        self._slice_items = 0
+        self._slice_start = None
+
+    def start(self):
+        # Called as the loop starts. Slices starting after the loop waited
+        # on the queue only get timed from the end of their first call.
+        self._slice_items = 0
+        self._slice_start = time.time()
+
+    def step(self, count, pending):
+        # Called once count calls have been processed, pending telling
+        # whether more of them are queued.
+        now = time.time()
+        if self._slice_start is None:
+            self._slice_start = now
+        self._slice_items += count
+        if not pending:
+            self._end_slice(now)
+            return
+        if ((self.max_items is not None
+                and self._slice_items >= self.max_items)
+                or (self.max_time is not None
+                    and now - self._slice_start >= self.max_time)):
+            self._end_slice(now)
+            self.yields += 1
+            gevent.sleep()
+            resumed = time.time()
+            self.lag = resumed - now
+            self.total_lag += self.lag
+            self.max_lag = max(self.max_lag, self.lag)
+            self._slice_start = resumed
+
+    def _end_slice(self, now):
+        duration = now - self._slice_start
+        self.slices += 1
+        self.items += self._slice_items
+        self.max_slice_items = max(self.max_slice_items, self._slice_items)
+        self.max_slice_time = max(self.max_slice_time, duration)
+        self.total_slice_time += duration
+        self._slice_items = 0
+        self._slice_start = None
+
+    def stats(self):
+        slices = self.slices or 1
+        yields = self.yields or 1
+        return {
+            'slices': self.slices,
+            'yields': self.yields,
+            'items': self.items,
+            'mean_slice_items': self.items / float(slices),
+            'max_slice_items': self.max_slice_items,
+            'mean_slice_time': self.total_slice_time / slices,
+            'max_slice_time': self.max_slice_time,
+            'last_lag': self.lag,
+            'mean_lag': self.total_lag / yields,
+            'max_lag': self.max_lag,
+        }
@@ -1,20 +1,216 @@
 from functools import wraps
 import logging
+import time
 import collections
+import weakref
 import gevent
+from . import tracing
+from .metrics import Histogram, DEFAULT_BUCKETS
+from .tracing import _tracers
 
 
 _LOG = logging.getLogger(__name__)
-logging.basicConfig()
 
 _Params = collections.namedtuple('Params', ('args', 'kwargs'))
 
+# A trampolined machine yields to the other greenlets once every so many
+# transitions, as it no longer goes through the hub on each of them.
+_TRAMPOLINE_YIELD_INTERVAL = 64
+
+# The live machines keeping a history, for state_statistics to go through
+_recorded_machines = weakref.WeakSet()
+
+# dwell is the time spent in from_state, None for the entry state
+Transition = collections.namedtuple(
+    'Transition', ('timestamp', 'from_state', 'to_state', 'dwell'))
+
 
 class StateValidationError(Exception):
     pass
 
 
+class _Transitioned(BaseException):
+    # Unwinds a trampolined state once it has moved to another, like the
+    # GreenletExit ending the greenlet of a regular state. As a
+    # BaseException, it goes through the states' except Exception clauses.
+    pass
+
+
+_TRANSITIONED = _Transitioned()
+
+
+# Whether transitions get logged. Python 2 loggers don't cache their
+# effective level, and looking it up costs a good share of a transition, so
+# it is only looked up whenever a machine starts, every
+# _LOGGING_REFRESH_INTERVAL transitions, or when refresh_logging() is called.
+_LOGGING_REFRESH_INTERVAL = 256
+_log_transitions = False
+_transitions_until_refresh = 0
+
+
+def refresh_logging():
+    global _log_transitions, _transitions_until_refresh
+    _log_transitions = _LOG.isEnabledFor(logging.DEBUG)
+    _transitions_until_refresh = _LOGGING_REFRESH_INTERVAL
+
+
+refresh_logging()
+
+
+def _log_transition(machine, from_state, to_state):
+    # The states and machine are also given as record attributes, for
+    # handlers which don't only look at the message.
+    extra = {'state_machine': machine, 'from_state': from_state,
+             'to_state': to_state}
+    if from_state is None:
+        _LOG.debug("Starting in state %r (%r)", to_state, machine,
+                   extra=extra)
+    else:
+        _LOG.debug("Moving to state %r (%r)", to_state, machine, extra=extra)
+
+
+class StateHistory(object):
+    # The last transitions of a machine, oldest first
+
+    def __init__(self, size):
+        self.transitions = collections.deque(maxlen=size)
+        self.entered_at = None
+
+    def record(self, from_state, to_state):
+        now = time.time()
+        dwell = None if self.entered_at is None else now - self.entered_at
+        self.transitions.append(Transition(now, from_state, to_state, dwell))
+        self.entered_at = now
+
+    def __iter__(self):
+        return iter(self.transitions)
+
+    def __len__(self):
+        return len(self.transitions)
+
+
+class StateStatistics(object):
+    # Aggregates the histories of many machines. Only the transitions
+    # still held by the histories are accounted for.
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        # state -> Histogram of the time spent in it before moving on
+        self.dwell = {}
+        # (from_state, to_state) -> number of transitions
+        self.edges = collections.Counter()
+        # state -> Histogram of the time spent so far by the machines
+        # still running in it
+        self.current = {}
+
+    def _observe(self, histograms, state, value):
+        histogram = histograms.get(state)
+        if histogram is None:
+            histogram = histograms[state] = Histogram(self._buckets)
+        histogram.observe(value)
+
+    def add(self, machine, now=None):
+        history = machine.history
+        if history is None:
+            return
+        for transition in history.transitions:
+            if transition.from_state is None:
+                continue
+            self.edges[transition.from_state, transition.to_state] += 1
+            self._observe(self.dwell, transition.from_state,
+                          transition.dwell)
+        if history.entered_at is not None and not machine.ready():
+            if now is None:
+                now = time.time()
+            self._observe(self.current, machine._state,
+                          now - history.entered_at)
+
+
+class StateRegistry(object):
+    # The live machines, by the state they are in. Machines are only held
+    # weakly, and are forgotten once they finish. A transition only moves
+    # the machine's id from a set to another, its weak reference being
+    # taken once.
+
+    def __init__(self):
+        # state -> ids of the machines in it
+        self._members = {}
+        # id -> weak reference to the machine
+        self._references = {}
+
+    def _moved(self, machine, from_state, to_state):
+        key = id(machine)
+        if from_state is None:
+            self._references[key] = weakref.KeyedRef(
+                machine, self._collected, key)
+        else:
+            self._members[from_state].discard(key)
+        members = self._members.get(to_state)
+        if members is None:
+            members = self._members[to_state] = set()
+        members.add(key)
+
+    def _finished(self, machine):
+        key = id(machine)
+        self._references.pop(key, None)
+        self._members[machine._state].discard(key)
+
+    def _collected(self, reference):
+        self._references.pop(reference.key, None)
+        for members in self._members.itervalues():
+            members.discard(reference.key)
+
+    def _get(self, state):
+        # states can be given as the decorated functions
+        return self._members.get(getattr(state, 'state', state), ())
+
+    def count(self, state):
+        return len(self._get(state))
+
+    def machines(self, state):
+        machines = []
+        for key in list(self._get(state)):
+            reference = self._references.get(key)
+            machine = reference and reference()
+            if machine is not None:
+                machines.append(machine)
+        return machines
+
+    def snapshot(self):
+        # state -> number of machines in it
+        return {state: len(members)
+                for state, members in self._members.items() if members}
+
+    def __len__(self):
+        return len(self._references)
+
+
+def state_statistics(buckets=DEFAULT_BUCKETS):
+    # Aggregates the histories of all the live machines keeping one
+    statistics = StateStatistics(buckets)
+    now = time.time()
+    for machine in list(_recorded_machines):
+        statistics.add(machine, now)
+    return statistics
+
+
+class _NoObserver(object):
+    # Stands in for the state coroutine while it is left to the default,
+    # sparing each machine a generator which would ignore its transitions.
+    __slots__ = ()
+
+    def send(self, transition):
+        pass
+
+
+_NO_OBSERVER = _NoObserver()
+
+
 class StateMachine(object):
+    # Lots of machines may be alive at once, mostly idle
+    __slots__ = ('_state', '_state_greenlet', '_state_coroutine',
+                 'trampolined', '_pending', 'history', 'registry',
+                 '__weakref__')
 
     @staticmethod
     def state_coroutine(state_machine):
@@ -23,6 +219,8 @@ class StateMachine(object):
 
     @staticmethod
     def create_state_coroutine(state_machine):
+        if StateMachine.state_coroutine is _default_state_coroutine:
+            return _NO_OBSERVER
         cr = StateMachine.state_coroutine(state_machine)
         cr.send(None)
         return cr
@@ -31,13 +229,31 @@ class StateMachine(object):
         self._state = None
         self._state_greenlet = None
         self._state_coroutine = self.create_state_coroutine(self)
+        self.trampolined = False
+        self._pending = None
+        self.history = None
+        self.registry = None
 
     def do_transition(self, to_state, params):
+        global _transitions_until_refresh
         if self._state is None:
-            _LOG.debug("Starting in state {!r} ({!r})".format(to_state, self))
+            refresh_logging()
+            self.trampolined = to_state.trampoline
+            if to_state.history:
+                self.history = StateHistory(to_state.history)
+                _recorded_machines.add(self)
+            self.registry = to_state.registry
         else:
             self._state.validate_transition(to_state)
-            _LOG.debug("Moving to state {!r} ({!r})".format(to_state, self))
+            _transitions_until_refresh -= 1
+            if not _transitions_until_refresh:
+                refresh_logging()
+        if _log_transitions:
+            _log_transition(self, self._state, to_state)
+
+        if self.trampolined:
+            self._schedule_transition(to_state, params)
+            return
 
         # FIXME: bodge fix for https://github.com/surfly/gevent/issues/394
         #
@@ -54,12 +270,57 @@ class StateMachine(object):
             self._state_greenlet)
 
         self._state_coroutine.send((from_state, to_state))
+        if self.history is not None:
+            self.history.record(from_state, to_state)
+        if self.registry is not None:
+            self.registry._moved(self, from_state, to_state)
+        if _tracers:
+            tracing.transition(self, from_state, to_state,
+                               self._state_greenlet)
 
         if old_greenlet and gevent.getcurrent() != old_greenlet:
             old_greenlet.kill()
 
         self._state_greenlet.start()
 
+    def _schedule_transition(self, to_state, params):
+        # The new state is run by the machine's greenlet once the current
+        # one returns.
+        if self._pending is not None:
+            raise StateValidationError(
+                "State {} already moved to {}".format(
+                    self._pending[0].name, to_state.name))
+        from_state, self._state = self._state, to_state
+        self._pending = (to_state, params)
+        starting = self._state_greenlet is None
+        if starting:
+            self._state_greenlet = TrampolineGreenlet(self, to_state)
+
+        self._state_coroutine.send((from_state, to_state))
+        if self.history is not None:
+            self.history.record(from_state, to_state)
+        if self.registry is not None:
+            self.registry._moved(self, from_state, to_state)
+        if _tracers:
+            tracing.transition(self, from_state, to_state,
+                               self._state_greenlet)
+
+        if starting:
+            self._state_greenlet.start()
+
+    def _run_states(self):
+        transitions = 0
+        while self._pending is not None:
+            (state, params), self._pending = self._pending, None
+            self._state_greenlet.state = state
+            try:
+                state(*params.args, **params.kwargs)
+            except _Transitioned:
+                pass
+            transitions += 1
+            if not transitions % _TRAMPOLINE_YIELD_INTERVAL:
+                gevent.sleep()
+
     def join(self, timeout=None):
         return self._state_greenlet.join(timeout=timeout)
 
@@ -74,24 +335,57 @@ class StateMachine(object):
         return self._state_greenlet.exception
 
 
+_default_state_coroutine = StateMachine.state_coroutine
+
+
+def state_machine(cls):
+    # Class decorator resolving the transitions of the states of a class,
+    # inherited ones included, to the states they name, so that those to
+    # unknown states fail on import.
+    def lookup(state, name):
+        target = getattr(getattr(cls, name, None), 'state', None)
+        if not isinstance(target, State):
+            raise StateValidationError(
+                "Unknown state {} in the transitions of {}.{}".format(
+                    name, cls.__name__, state.name))
+        return target
+
+    for klass in cls.__mro__:
+        for value in vars(klass).values():
+            state = getattr(value, 'state', None)
+            if isinstance(state, State):
+                state.resolve(lookup)
+    return cls
+
+
 class State(object):
 
-    def __init__(self, function, transitions_to=None, on_start=None):
+    def __init__(self, function, transitions_to=None, on_start=None,
+                 trampoline=False, history=None, registry=None):
         self._function = function
+        self.name = function.func_name
+        self.trampoline = trampoline
+        self.history = history
+        self.registry = registry
         if transitions_to is None:
             transitions_to = []
         elif not isinstance(transitions_to, (tuple, list, set)):
             transitions_to = [transitions_to]
-        self._transitions_out = frozenset(transitions_to)
+        self.transitions_out = frozenset(transitions_to)
         self._on_start = on_start
+        # the states named by transitions_out, once resolved
+        self.targets = frozenset()
 
-    @property
-    def name(self):
-        return self._function.func_name
+    def resolve(self, lookup):
+        self.targets = frozenset(lookup(self, name)
+                                 for name in self.transitions_out)
 
     def validate_transition(self, to_state):
-        if (self._transitions_out is not None
-                and to_state.name not in self._transitions_out):
+        if to_state in self.targets:
+            return
+        # not resolved, or a same named state declared elsewhere, such as
+        # a subclass overriding the target
+        if to_state.name not in self.transitions_out:
             raise StateValidationError(
                 "Invalid state transition {} -> {}".format(
                     self.name, to_state.name))
@@ -106,6 +400,7 @@ class State(object):
 
 
 class StateGreenlet(gevent.Greenlet):
+    __slots__ = ('state_machine', 'state')
 
     def __init__(self, state_machine, state, params):
         self.state_machine = state_machine
@@ -113,6 +408,29 @@ class StateGreenlet(gevent.Greenlet):
         super(StateGreenlet, self).__init__(state,
                                             *params.args,
                                             **params.kwargs)
+        if state_machine.registry is not None:
+            self.rawlink(_unregister)
+
+
+class TrampolineGreenlet(StateGreenlet):
+    # Runs all the states of a trampolined machine, one after the other
+    __slots__ = ()
+
+    def __init__(self, state_machine, state):
+        self.state_machine = state_machine
+        self.state = state
+        gevent.Greenlet.__init__(self, state_machine._run_states)
+        if state_machine.registry is not None:
+            self.rawlink(_unregister)
+
+
+def _unregister(greenlet):
+    # Linked to the greenlets of registered machines, for those killed
+    # before they even started to be forgotten too.
+    machine = greenlet.state_machine
+    # unless the machine moved on to another greenlet
+    if machine._state_greenlet is greenlet:
+        machine.registry._finished(machine)
 
 
 def spawn_state(state, params):
@@ -127,20 +445,27 @@ def spawn_state(state, params):
     state_machine.do_transition(to_state=state, params=params)
 
     # A StateGreenlet must exit immediately if they start a new state
-    # greenlet
+    # greenlet. A trampolined state is only unwound, for its greenlet to
+    # carry on with the new state.
     if is_state_greenlet:
+        if state_machine.trampolined:
+            raise _TRANSITIONED
         raise gevent.GreenletExit()
 
     return state_machine
 
 
-def state(function=None, transitions_to=None, on_start=None):
+def state(function=None, transitions_to=None, on_start=None,
+          trampoline=False, history=None, registry=None):
     def func_wrapper(fun):
-        state = State(fun, transitions_to=transitions_to, on_start=on_start)
+        state = State(fun, transitions_to=transitions_to, on_start=on_start,
+                      trampoline=trampoline, history=history,
+                      registry=registry)
 
         @wraps(fun)
         def wrapped(*args, **kwargs):
             return spawn_state(state=state, params=_Params(args, kwargs))
+        wrapped.state = state
         return wrapped
 
     if function is None:
@@ -0,0 +1,197 @@
+import collections
+import json
+import os
+import random
+import time
+import gevent
+
+__author__ = 'ocarrere'
+
+# Never rebound, so that the modules firing the hooks can hold on to it and
+# only pay for a truth test while no tracer is registered.
+_tracers = []
+
+
+class TraceContext(collections.namedtuple(
+        'TraceContext', ('trace_id', 'span_id', 'parent_id'))):
+    __slots__ = ()
+
+    def child(self):
+        return TraceContext(self.trace_id, _new_id(), self.span_id)
+
+
+def _new_id():
+    return random.getrandbits(63)
+
+
+def current_context():
+    return getattr(gevent.getcurrent(), 'trace_context', None)
+
+
+def set_context(context):
+    # Sets the context of the current greenlet, returning the previous one
+    greenlet = gevent.getcurrent()
+    previous = getattr(greenlet, 'trace_context', None)
+    greenlet.trace_context = context
+    return previous
+
+
+def start_trace(trace_id=None):
+    # Starts a new trace in the current greenlet, or carries on with one
+    # whose id was received from elsewhere.
+    if trace_id is None:
+        trace_id = _new_id()
+    context = TraceContext(trace_id, _new_id(), None)
+    set_context(context)
+    return context
+
+
+def _child_context():
+    parent = current_context()
+    if parent is None:
+        return TraceContext(_new_id(), _new_id(), None)
+    return parent.child()
+
+
+class Tracer(object):
+    # Receives the tracing events. Every method does nothing by default.
+
+    def call_queued(self, target, call):
+        pass
+
+    def call_started(self, target, call):
+        pass
+
+    def call_finished(self, target, call, error):
+        pass
+
+    def transition(self, machine, from_state, to_state, context):
+        pass
+
+
+def add_tracer(tracer):
+    _tracers.append(tracer)
+
+
+def remove_tracer(tracer):
+    _tracers.remove(tracer)
+
+
+def call_queued(target, call):
+    # The call gets a context of its own, child of the caller's
+    call.trace_context = _child_context()
+    for tracer in _tracers:
+        tracer.call_queued(target, call)
+
+
+class _Span(object):
+    __slots__ = ('_target', '_call', '_greenlet', '_previous')
+
+    def __init__(self, target, call):
+        self._target = target
+        self._call = call
+        # whatever the call does is part of its trace
+        self._greenlet = gevent.getcurrent()
+        self._previous = getattr(self._greenlet, 'trace_context', None)
+        self._greenlet.trace_context = getattr(call, 'trace_context', None)
+        for tracer in _tracers:
+            tracer.call_started(target, call)
+
+    def finish(self, error):
+        for tracer in _tracers:
+            tracer.call_finished(self._target, self._call, error)
+        self._greenlet.trace_context = self._previous
+
+
+def call_started(target, call):
+    return _Span(target, call)
+
+
+def transition(machine, from_state, to_state, greenlet):
+    # The greenlet running the new state carries on with the trace
+    context = current_context()
+    greenlet.trace_context = context
+    for tracer in _tracers:
+        tracer.transition(machine, from_state, to_state, context)
+
+
+def _timestamp():
+    return time.time() * 1e6
+
+
+class ChromeTraceRecorder(Tracer):
+    # Records the events in the Chrome trace event format, which can be
+    # loaded in chrome://tracing or Perfetto. Every handler and state
+    # machine gets a track of its own; calls are drawn from the time they
+    # start to the time they finish, with an arrow from where they were
+    # queued.
+
+    def __init__(self):
+        self.events = []
+        self._pid = os.getpid()
+        self._tracks = set()
+        self._started = {}
+
+    def _track(self, owner):
+        track = id(owner)
+        if track not in self._tracks:
+            self._tracks.add(track)
+            self.events.append({
+                'ph': 'M', 'name': 'thread_name', 'pid': self._pid,
+                'tid': track, 'args': {'name': '{}@{:x}'.format(
+                    type(owner).__name__, track)}})
+        return track
+
+    @staticmethod
+    def _args(context):
+        if context is None:
+            return {}
+        return {'trace_id': '{:x}'.format(context.trace_id),
+                'span_id': '{:x}'.format(context.span_id),
+                'parent_id': (None if context.parent_id is None
+                              else '{:x}'.format(context.parent_id))}
+
+    def call_queued(self, target, call):
+        self.events.append({
+            'ph': 's', 'name': call.name, 'cat': 'call',
+            'id': call.trace_context.span_id,
+            'ts': _timestamp(), 'pid': self._pid,
+            'tid': self._track(gevent.getcurrent())})
+
+    def call_started(self, target, call):
+        track = self._track(target)
+        start = _timestamp()
+        self._started[id(call)] = start
+        context = getattr(call, 'trace_context', None)
+        if context is not None:
+            self.events.append({
+                'ph': 'f', 'bp': 'e', 'name': call.name, 'cat': 'call',
+                'id': context.span_id, 'ts': start, 'pid': self._pid,
+                'tid': track})
+
+    def call_finished(self, target, call, error):
+        end = _timestamp()
+        start = self._started.pop(id(call), end)
+        args = self._args(getattr(call, 'trace_context', None))
+        if error is not None:
+            args['error'] = repr(error)
+        self.events.append({
+            'ph': 'X', 'name': call.name, 'cat': 'call', 'ts': start,
+            'dur': end - start, 'pid': self._pid, 'tid': self._track(target),
+            'args': args})
+
+    def transition(self, machine, from_state, to_state, context):
+        self.events.append({
+            'ph': 'i', 's': 't', 'cat': 'state',
+            'name': '{} -> {}'.format(from_state and from_state.name,
+                                      to_state.name),
+            'ts': _timestamp(), 'pid': self._pid,
+            'tid': self._track(machine), 'args': self._args(context)})
+
+    def dump(self, output):
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                  output)
+
+    def save(self, path):
+        with open(path, 'w') as output:
+            self.dump(output)
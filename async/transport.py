@@ -0,0 +1,130 @@
+import errno
+import os
+import functools
+import gevent
+from gevent import socket
+from gevent.queue import Queue
+from gevent.server import StreamServer
+from logging import getLogger
+from .call import QueueFull, _SyncCall
+from .pool import _Sharded
+from .remote import (RemoteTarget, get_serializer, receive_frame,
+                     send_frame, unmarshal_call, marshal_outcome, _CANCEL)
+
+__author__ = 'ocarrere'
+
+_LOG = getLogger(__name__)
+
+
+class HandlerServer(object):
+    # Exposes a handler on a unix socket. The calls received are queued
+    # on the handler, which keeps being processed as usual by its owner.
+    #
+    # Pickled calls can run any code in the process: only the owner of the
+    # socket gets to connect to it by default.
+
+    def __init__(self, handler, path, serializer=None, backlog=128,
+                 mode=0o600):
+        self._handler = handler
+        self._path = path
+        self._serializer = get_serializer(serializer)
+        self._backlog = backlog
+        self._mode = mode
+        self._server = None
+
+    def start(self):
+        try:
+            os.unlink(self._path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the socket must not be reachable with the umask's permissions,
+        # even until it gets its own
+        umask = os.umask(0o777 & ~self._mode)
+        try:
+            listener.bind(self._path)
+        finally:
+            os.umask(umask)
+        os.chmod(self._path, self._mode)
+        listener.listen(self._backlog)
+        self._server = StreamServer(listener, self._serve)
+        self._server.start()
+
+    def stop(self, timeout=None):
+        self._server.stop(timeout=timeout)
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def _serve(self, connection, address):
+        # Calls are read and queued as they come, while their outcome is
+        # written back as soon as it is known, so that clients can pipeline
+        # their calls.
+        replies = Queue()
+        in_flight = {}
+        writer = gevent.spawn(self._write, connection, replies)
+        try:
+            while True:
+                frame = receive_frame(connection)
+                if frame is None:
+                    break
+                if frame[1] == _CANCEL:
+                    # the client stopped waiting for the call
+                    call = in_flight.get(frame[0])
+                    if call is not None:
+                        call.cancel()
+                    continue
+                call = unmarshal_call(connection, frame, self._serializer)
+                if call is None:
+                    continue
+                if isinstance(call, _SyncCall):
+                    in_flight[frame[0]] = call
+                    call.rawlink(functools.partial(
+                        self._reply, replies, in_flight, frame[0]))
+                try:
+                    self._handler.add_request(call)
+                except QueueFull as error:
+                    if isinstance(call, _SyncCall):
+                        call._resolve(None, error)
+            # the client is done sending calls, but still expects the
+            # outcome of those in flight
+            gevent.wait(in_flight.values())
+        except socket.error as error:
+            _LOG.debug("Connection failed: {}".format(error))
+        finally:
+            replies.put(StopIteration)
+            writer.join()
+            connection.close()
+
+    @staticmethod
+    def _reply(replies, in_flight, request_id, call):
+        del in_flight[request_id]
+        replies.put_nowait((request_id, call))
+
+    def _write(self, connection, replies):
+        for request_id, call in replies:
+            success, outcome = marshal_outcome(call, self._serializer)
+            try:
+                send_frame(connection, request_id, success, outcome)
+            except socket.error as error:
+                _LOG.debug("Could not reply: {}".format(error))
+                return
+
+
+class HandlerClient(_Sharded):
+    # Client side of a HandlerServer, spreading the calls over a pool of
+    # connections.
+
+    def __init__(self, path, serializer=None, connections=1):
+        targets = []
+        for _ in xrange(connections):
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(path)
+            targets.append(RemoteTarget(connection, serializer))
+        super(HandlerClient, self).__init__(targets, key=None)
+
+    def close(self):
+        for target in self.handlers:
+            target.close()
@@ -0,0 +1,74 @@
+"""Runs the benchmark suite.
+
+Run with ``python -m benchmarks``; see ``--help`` for saving the results
+and comparing them against a baseline.
+"""
+import argparse
+import json
+import platform
+import sys
+import gevent
+from . import calls, states, call_overhead
+from .compare import regressions, over_budget
+
+SUITES = {
+    'calls': calls.BENCHMARKS,
+    'states': states.BENCHMARKS,
+    'overhead': [call_overhead.summary],
+}
+
+BUDGETS = {'states.{}'.format(name): budget
+           for name, budget in states.BUDGETS.items()}
+
+
+def run(suites):
+    results = {}
+    for suite in suites:
+        for benchmark in SUITES[suite]:
+            for name, value in sorted(benchmark().items()):
+                name = '{}.{}'.format(suite, name)
+                print("{:<40} {:>14.2f}".format(name, value))
+                results[name] = value
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help="among {}, all by default".format(
+                            ', '.join(sorted(SUITES))))
+    parser.add_argument('--output', help="where to save the results as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=.2,
+                        help="relative change considered a regression")
+    options = parser.parse_args(argv)
+    for suite in options.suites:
+        if suite not in SUITES:
+            parser.error("unknown suite {}".format(suite))
+
+    results = run(options.suites or sorted(SUITES))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({'python': platform.python_version(),
+                       'gevent': gevent.__version__,
+                       'results': results}, output, indent=2, sort_keys=True)
+
+    status = 0
+    for name, budget, result in over_budget(results, BUDGETS):
+        print("OVER BUDGET {}: {:.2f} > {:.2f}".format(name, result, budget))
+        status = 1
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            found = regressions(results, json.load(baseline)['results'],
+                                options.tolerance)
+        for name, expected, result, change in found:
+            print("REGRESSION {}: {:.2f} -> {:.2f} ({:.0%} worse)".format(
+                name, expected, result, change))
+        if found:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Per-call overhead of the sync and oneway deferred calls.
+
+Run with ``python -m benchmarks.call_overhead``.
+"""
+import gc
+import sys
+import timeit
+import gevent
+from gevent.event import Event
+from async import DeferredCallHandler
+
+
+class _Handler(DeferredCallHandler):
+    def noop(self, *args, **kwargs):
+        pass
+
+
+def _live_objects():
+    gc.collect()
+    objects = gc.get_objects()
+    return len(objects), sum(sys.getsizeof(obj) for obj in objects)
+
+
+def _retained(setup, count):
+    before = _live_objects()
+    keep = setup(count)
+    after = _live_objects()
+    del keep
+    return ((after[0] - before[0]) / float(count),
+            (after[1] - before[1]) / float(count))
+
+
+def oneway_retained(count=10000):
+    def setup(count):
+        handler = _Handler()
+        for index in xrange(count):
+            handler.oneway.noop(index)
+        return handler
+    return _retained(setup, count)
+
+
+def sync_retained(count=2000):
+    # what an in-flight sync call costs, on top of a greenlet blocked on
+    # an event
+    def blocked(count):
+        event = Event()
+        greenlets = [gevent.spawn(event.wait) for _ in xrange(count)]
+        gevent.sleep()
+        return event, greenlets
+
+    def in_flight(count):
+        handler = _Handler()
+        greenlets = [gevent.spawn(handler.sync.noop, index)
+                     for index in xrange(count)]
+        gevent.sleep()
+        return handler, greenlets
+
+    base_objects, base_size = _retained(blocked, count)
+    objects, size = _retained(in_flight, count)
+    return objects - base_objects, size - base_size
+
+
+def sync_latency(count=20000):
+    handler = _Handler()
+    processor = gevent.spawn(handler.process, forever=True)
+    call = handler.sync.noop
+    elapsed = timeit.timeit(lambda: call(1), number=count)
+    handler.stop_processing()
+    processor.join()
+    return elapsed / count
+
+
+def oneway_latency(count=100000):
+    handler = _Handler()
+    call = handler.oneway.noop
+    start = timeit.default_timer()
+    for index in xrange(count):
+        call(index)
+    handler.process()
+    return (timeit.default_timer() - start) / count
+
+
+def summary():
+    oneway_objects, oneway_size = oneway_retained()
+    sync_objects, sync_size = sync_retained()
+    return {
+        'oneway_call_objects': oneway_objects,
+        'oneway_call_bytes': oneway_size,
+        'sync_call_objects': sync_objects,
+        'sync_call_bytes': sync_size,
+        'sync_round_trip_us': sync_latency() * 1e6,
+        'oneway_call_us': oneway_latency() * 1e6,
+    }
+
+
+def main():
+    objects, size = oneway_retained()
+    print("oneway: {:.1f} objects, {:.0f} bytes per queued call".format(
+        objects, size))
+    objects, size = sync_retained()
+    print("sync: {:.1f} objects, {:.0f} bytes per in-flight call".format(
+        objects, size))
+    print("sync round trip: {:.2f} us".format(sync_latency() * 1e6))
+    print("oneway enqueue + execute: {:.2f} us".format(
+        oneway_latency() * 1e6))
+
+
+if __name__ == '__main__':
+    main()
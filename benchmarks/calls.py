@@ -0,0 +1,105 @@
+"""Latency and throughput of the deferred calls under various loads."""
+import timeit
+import gevent
+from gevent import Timeout
+from async import DeferredCallHandler
+
+
+class _Handler(DeferredCallHandler):
+    def noop(self, *args, **kwargs):
+        pass
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    samples = sorted(samples)
+    return dict(
+        ('p{:g}'.format(point).replace('.', '_'),
+         samples[min(len(samples) - 1, int(len(samples) * point / 100.))])
+        for point in points)
+
+
+def _processing(handler):
+    return gevent.spawn(handler.process, forever=True)
+
+
+def _stop(handler, processor):
+    handler.stop_processing()
+    processor.join()
+
+
+def sync_latency(count=20000):
+    handler = _Handler()
+    processor = _processing(handler)
+    call = handler.sync.noop
+    timer = timeit.default_timer
+    samples = []
+    for index in xrange(count):
+        start = timer()
+        call(index)
+        samples.append((timer() - start) * 1e6)
+    _stop(handler, processor)
+    return dict(('sync_latency_{}_us'.format(point), value)
+                for point, value in percentiles(samples).items())
+
+
+def oneway_throughput(count=100000):
+    handler = _Handler()
+    processor = _processing(handler)
+    call = handler.oneway.noop
+    start = timeit.default_timer()
+    for index in xrange(count):
+        call(index)
+    # the sync call only returns once all the others were processed
+    handler.sync.noop()
+    elapsed = timeit.default_timer() - start
+    _stop(handler, processor)
+    return {'oneway_calls_per_s': count / elapsed}
+
+
+def fan_in(producers=100, calls=200):
+    # Many greenlets calling a single handler at once
+    handler = _Handler()
+    processor = _processing(handler)
+    timer = timeit.default_timer
+    samples = []
+
+    def produce():
+        call = handler.sync.noop
+        for index in xrange(calls):
+            start = timer()
+            call(index)
+            samples.append((timer() - start) * 1e6)
+
+    start = timer()
+    gevent.joinall([gevent.spawn(produce) for _ in xrange(producers)])
+    elapsed = timer() - start
+    _stop(handler, processor)
+    results = {'fan_in_calls_per_s': producers * calls / elapsed}
+    results.update(('fan_in_latency_{}_us'.format(point), value)
+                   for point, value in percentiles(samples).items())
+    return results
+
+
+def timeouts(count=10000):
+    # Callers giving up on a busy handler, which then has to skip their
+    # calls
+    handler = _Handler()
+
+    def call():
+        try:
+            handler.sync(timeout=.001).noop()
+        except Timeout:
+            pass
+
+    start = timeit.default_timer()
+    gevent.joinall([gevent.spawn(call) for _ in xrange(count)])
+    timed_out = timeit.default_timer() - start
+    start = timeit.default_timer()
+    handler.process()
+    skipped = timeit.default_timer() - start
+    assert handler.cancelled_count == count
+    return {'timed_out_call_us': timed_out / count * 1e6,
+            'skipped_call_us': skipped / count * 1e6}
+
+
+BENCHMARKS = [sync_latency, oneway_throughput, fan_in, timeouts]
@@ -0,0 +1,30 @@
+"""Comparison of benchmark results against a baseline."""
+
+# Results are lower is better, apart from the rates
+_HIGHER_IS_BETTER = ('_per_s',)
+
+
+def higher_is_better(name):
+    return name.endswith(_HIGHER_IS_BETTER)
+
+
+def regressions(results, baseline, tolerance=.2):
+    # Returns (name, baseline, result, relative change) for every result
+    # which got worse than its baseline by more than the tolerance.
+    found = []
+    for name, expected in sorted(baseline.items()):
+        if name not in results or not expected:
+            continue
+        change = (results[name] - expected) / float(expected)
+        if higher_is_better(name):
+            change = -change
+        if change > tolerance:
+            found.append((name, expected, results[name], change))
+    return found
+
+
+def over_budget(results, budgets):
+    # Returns (name, budget, result) for every result above its budget
+    return [(name, budget, results[name])
+            for name, budget in sorted(budgets.items())
+            if name in results and results[name] > budget]
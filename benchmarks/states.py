@@ -0,0 +1,158 @@
+"""Transition rate and memory footprint of the state machines."""
+import importlib
+import logging
+import timeit
+import gevent
+from gevent.event import Event
+from async import state, StateRegistry
+from .call_overhead import _retained
+
+
+class _PingPong(object):
+    @state(transitions_to=['pong'])
+    def ping(self, count):
+        if count:
+            self.pong(count - 1)
+
+    @state(transitions_to=['ping'])
+    def pong(self, count):
+        if count:
+            self.ping(count - 1)
+
+
+class _TrampolinedPingPong(object):
+    @state(transitions_to=['pong'], trampoline=True)
+    def ping(self, count):
+        if count:
+            return self.pong(count - 1)
+
+    @state(transitions_to=['ping'])
+    def pong(self, count):
+        if count:
+            return self.ping(count - 1)
+
+
+_REGISTRY = StateRegistry()
+
+
+class _RegisteredPingPong(object):
+    @state(transitions_to=['pong'], trampoline=True, registry=_REGISTRY)
+    def ping(self, count):
+        if count:
+            return self.pong(count - 1)
+
+    @state(transitions_to=['ping'])
+    def pong(self, count):
+        if count:
+            return self.ping(count - 1)
+
+
+class _Idle(object):
+    def __init__(self, event):
+        self.event = event
+
+    @state
+    def waiting(self):
+        self.event.wait()
+
+
+def _transition_rate(machine_class, count):
+    start = timeit.default_timer()
+    machine = machine_class().ping(count)
+    # join() only waits for the state the machine is in at the time
+    while not machine.ready():
+        machine.join()
+    return count / (timeit.default_timer() - start)
+
+
+def transition_rate(count=20000):
+    return {'transitions_per_s': _transition_rate(_PingPong, count)}
+
+
+def trampoline_transition_rate(count=200000):
+    return {'trampoline_transitions_per_s':
+            _transition_rate(_TrampolinedPingPong, count)}
+
+
+def registered_transition_rate(count=200000):
+    return {'registered_trampoline_transitions_per_s':
+            _transition_rate(_RegisteredPingPong, count)}
+
+
+# the package exports the decorator under the module's name
+_state_module = importlib.import_module('async.state')
+
+
+class _StubLogger(object):
+    # stands in for the logger of the machines, never enabled, so that
+    # there is nothing to look up
+    def isEnabledFor(self, level):
+        return False
+
+
+def _stubbed_rate(count):
+    logger, _state_module._LOG = _state_module._LOG, _StubLogger()
+    try:
+        _state_module.refresh_logging()
+        return _transition_rate(_TrampolinedPingPong, count)
+    finally:
+        _state_module._LOG = logger
+        _state_module.refresh_logging()
+
+
+def transition_logging(count=400000, rounds=11):
+    # What logging costs a transition when disabled, compared with a stub
+    # logger, and when enabled. Both are measured in each round, the
+    # median of the rounds leaving out the noise.
+    logger = logging.getLogger('async.state')
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    overheads = []
+    try:
+        for index in xrange(rounds):
+            # alternately first, for neither to always run warmer
+            if index % 2:
+                stubbed = _stubbed_rate(count / rounds)
+            disabled = _transition_rate(_TrampolinedPingPong, count / rounds)
+            if not index % 2:
+                stubbed = _stubbed_rate(count / rounds)
+            overheads.append((stubbed / disabled - 1) * 100)
+        logger.setLevel(logging.DEBUG)
+        enabled = _transition_rate(_TrampolinedPingPong, count / 10)
+    finally:
+        logger.setLevel(level)
+    return {'disabled_logging_overhead_pct':
+            max(0., sorted(overheads)[rounds // 2]),
+            'logged_trampoline_transitions_per_s': enabled}
+
+
+def machine_memory(count=5000):
+    # what an idle machine costs, its greenlet included, with and without
+    # gevent keeping the stack each greenlet was spawned from
+    event = Event()
+
+    def setup(count):
+        return [_Idle(event).waiting() for _ in xrange(count)]
+
+    objects, size = _retained(setup, count)
+    tracked = gevent.config.track_greenlet_tree
+    gevent.config.track_greenlet_tree = False
+    try:
+        _, untracked_size = _retained(setup, count)
+    finally:
+        gevent.config.track_greenlet_tree = tracked
+    event.set()
+    return {'machine_objects': objects, 'machine_bytes': size,
+            'untracked_machine_bytes': untracked_size}
+
+
+BENCHMARKS = [transition_rate, trampoline_transition_rate,
+              registered_transition_rate, transition_logging, machine_memory]
+
+# Hard limits, whatever the baseline. Sizes depend on the python build
+# rather than on the machine, unlike timings, and so do relative ones.
+BUDGETS = {
+    'disabled_logging_overhead_pct': 3.,
+    'machine_bytes': 3584,
+    'untracked_machine_bytes': 2816,
+}
@@ -72,7 +72,7 @@ setup(
     author_email='olivier.carrere@gmail.com',
     url='http://github.com/kapouille/gevent_async',
     keywords='gevent state asychronous synchronous',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     include_package_data=True,
     zip_safe=False,
     install_requires=read_requirements('requirements.txt'),
@@ -1,6 +1,13 @@
 from gevent import sleep, spawn, Timeout
-from async import DeferredCallHandler
+from gevent.monkey import get_original
+from async import DeferredCallHandler, coalesce, priority, offload
+from async import wait_all, wait_any, SlicePolicy
+from async import HIGH_PRIORITY, LOW_PRIORITY
+from async import QueueFull, CallCancelled
+from async import OVERFLOW_BLOCK, OVERFLOW_BLOCK_TIMEOUT
+from async import OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_RAISE
 from unittest2 import TestCase
+from async.call import _SyncCall
 
 
 class TestDeferredCalls(TestCase):
@@ -79,6 +86,80 @@ class TestDeferredCalls(TestCase):
                           handler.sync(timeout=.1).takes_too_long)
         handler.stop_processing()
 
+    def test_timeout_isolation(self):
+        class Handler(DeferredCallHandler):
+            def takes_a_while(self):
+                sleep(.05)
+                return True
+
+        handler = Handler()
+        self.assertIs(handler.sync(timeout=1), handler.sync(timeout=1))
+        self.assertIsNot(handler.sync(timeout=1), handler.sync)
+
+        # setting up a timeout must not leak into other callers' calls
+        short = handler.sync(timeout=.01)
+        spawn(handler.process, forever=True)
+        self.assertTrue(handler.sync.takes_a_while())
+        self.assertRaises(Timeout, short.takes_a_while)
+        handler.stop_processing()
+
+    def test_timed_out_call_skipped(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__()
+                self.executed = []
+
+            def do_something(self, value):
+                self.executed.append(value)
+
+        handler = Handler()
+        self.assertRaises(Timeout,
+                          handler.sync(timeout=.01).do_something, 1)
+        handler.oneway.do_something(2)
+        handler.process()
+        self.assertEqual(handler.executed, [2])
+        self.assertEqual(handler.cancelled_count, 1)
+
+    def test_cancellation(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self, **kwargs):
+                super(Handler, self).__init__(**kwargs)
+                self.executed = []
+
+            def do_something(self, value):
+                self.executed.append(value)
+
+        # the caller went away
+        handler = Handler()
+        caller = spawn(handler.sync.do_something, 1)
+        sleep()
+        caller.kill()
+        handler.process()
+        self.assertEqual(handler.executed, [])
+        self.assertEqual(handler.cancelled_count, 1)
+
+        # explicit cancellation
+        handler = Handler()
+        call = _SyncCall('do_something', 2)
+        handler.add_request(call)
+        self.assertTrue(call.cancel())
+        self.assertFalse(call.cancel())
+        self.assertRaises(CallCancelled, call.wait, None)
+        handler.process(batched=True)
+        self.assertEqual(handler.executed, [])
+        self.assertEqual(handler.cancelled_count, 1)
+
+        # cancelled calls make room in a full queue
+        handler = Handler(maxsize=1, overflow=OVERFLOW_RAISE)
+        call = _SyncCall('do_something', 3)
+        handler.add_request(call)
+        call.cancel()
+        handler.oneway.do_something(4)
+        handler.process()
+        self.assertEqual(handler.executed, [4])
+        self.assertEqual(handler.cancelled_count, 1)
+        self.assertFalse(handler.overflow_counts)
+
     def test_oneway(self):
         class Handler(DeferredCallHandler):
             def __init__(self):
@@ -118,3 +199,432 @@ class TestDeferredCalls(TestCase):
         self.assertIsNone(result)
 
         handler.stop_processing()
+
+    def test_batched_process(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__()
+                self.batches = []
+                self.values = []
+
+            def process_batch(self, calls):
+                self.batches.append(len(calls))
+                super(Handler, self).process_batch(calls)
+
+            def store(self, value):
+                self.values.append(value)
+
+        handler = Handler()
+        for value in range(10):
+            handler.oneway.store(value)
+        handler.process(batched=True)
+        self.assertEqual(handler.batches, [10])
+        self.assertEqual(handler.values, range(10))
+
+        handler = Handler()
+        for value in range(10):
+            handler.oneway.store(value)
+        handler.process(batched=True, max_batch_size=4)
+        self.assertEqual(handler.batches, [4, 4, 2])
+        self.assertEqual(handler.values, range(10))
+
+    def test_batched_process_forever(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__()
+                self.batches = []
+
+            def process_batch(self, calls):
+                self.batches.append(len(calls))
+                super(Handler, self).process_batch(calls)
+
+            def the_answer_to_the_universe_and_everything(self):
+                return 42
+
+        handler = Handler()
+        processor = spawn(handler.process, forever=True, batched=True)
+        for _ in range(3):
+            handler.oneway.the_answer_to_the_universe_and_everything()
+        answer = handler.sync.the_answer_to_the_universe_and_everything()
+        self.assertEqual(answer, 42)
+        self.assertEqual(handler.batches, [4])
+        handler.stop_processing()
+        processor.join(timeout=1)
+        self.assertTrue(processor.ready())
+
+    def test_whitelist(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__(indexed=True)
+                self.calls = []
+
+            def setup(self, value):
+                self.calls.append(('setup', value))
+
+            def update(self, value):
+                self.calls.append(('update', value))
+
+        handler = Handler()
+        handler.oneway.update(1)
+        handler.oneway.setup(2)
+        update = handler.deferred.update(3)
+        handler.oneway.setup(4)
+        handler.process(whitelist=['setup'])
+        self.assertEqual(handler.calls, [('setup', 2), ('setup', 4)])
+        # the others are left queued, in order
+        self.assertFalse(update.ready())
+        handler.process()
+        self.assertEqual(handler.calls[2:], [('update', 1), ('update', 3)])
+        self.assertTrue(update.successful())
+
+        handler = Handler()
+        processor = spawn(handler.process, forever=True,
+                          whitelist=frozenset(['setup']), batched=True)
+        handler.oneway.update(1)
+        handler.sync.setup(2)
+        handler.stop_processing()
+        processor.join(timeout=1)
+        self.assertTrue(processor.ready())
+        self.assertEqual(handler.calls, [('setup', 2)])
+        handler.process()
+        self.assertEqual(handler.calls[1:], [('update', 1)])
+
+    def test_whitelist_prioritized(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self, indexed):
+                super(Handler, self).__init__(prioritized=True,
+                                              indexed=indexed)
+                self.calls = []
+
+            def setup(self, value):
+                self.calls.append(('setup', value))
+
+            def update(self, value):
+                self.calls.append(('update', value))
+
+        for indexed in [False, True]:
+            handler = Handler(indexed)
+            handler.oneway.setup(1)
+            handler.oneway.update(2)
+            handler.oneway(priority=HIGH_PRIORITY).setup(3)
+            handler.process(whitelist=['setup'])
+            self.assertEqual(handler.calls, [('setup', 3), ('setup', 1)])
+            handler.process()
+            self.assertEqual(handler.calls[2:], [('update', 2)])
+
+    def test_whitelist_unindexed(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__(prioritized=True)
+                self.calls = []
+
+            def setup(self, value):
+                self.calls.append(('setup', value))
+
+            def update(self, value):
+                self.calls.append(('update', value))
+
+        handler = Handler()
+        handler.oneway.update(1)
+        handler.oneway.setup(2)
+        handler.oneway(priority=HIGH_PRIORITY).update(3)
+        handler.oneway.setup(4)
+        handler.process(whitelist=['setup'])
+        self.assertEqual(handler.calls, [('setup', 2), ('setup', 4)])
+        handler.process()
+        self.assertEqual(handler.calls[2:], [('update', 3), ('update', 1)])
+
+        processor = spawn(handler.process, forever=True,
+                          whitelist=['setup'])
+        handler.oneway.update(5)
+        sleep()
+        self.assertEqual(len(handler.calls), 4)
+        handler.sync.setup(6)
+        handler.stop_processing()
+        processor.join(timeout=1)
+        self.assertTrue(processor.ready())
+        self.assertEqual(handler.calls[4:], [('setup', 6)])
+        handler.process()
+        self.assertEqual(handler.calls[5:], [('update', 5)])
+
+    def test_slicing(self):
+        class Handler(DeferredCallHandler):
+            def noop(self):
+                pass
+
+            def busy(self):
+                get_original('time', 'sleep')(.002)
+
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(handler.slicing.items)
+                sleep(0)
+
+        handler = Handler(slicing=SlicePolicy(max_items=100))
+        for _ in range(1000):
+            handler.oneway.noop()
+        ticker = spawn(tick)
+        sleep(0)
+        handler.process()
+        ticker.kill()
+        self.assertEqual(ticks[1:10], range(100, 1000, 100))
+        stats = handler.slicing.stats()
+        self.assertEqual(stats['items'], 1000)
+        self.assertEqual(stats['slices'], 10)
+        self.assertEqual(stats['yields'], 9)
+        self.assertEqual(stats['max_slice_items'], 100)
+
+        handler = Handler(slicing=SlicePolicy(max_time=.005))
+        for _ in range(10):
+            handler.oneway.busy()
+        handler.process(batched=True, max_batch_size=1)
+        self.assertEqual(handler.slicing.items, 10)
+        # sleeps may overshoot, making for shorter slices
+        self.assertTrue(3 <= handler.slicing.yields < 10)
+        self.assertTrue(handler.slicing.max_slice_time >= .005)
+
+    def test_coalesced_oneway(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__()
+                self.updates = []
+
+            @coalesce(key=lambda resource, value: resource)
+            def update_resource(self, resource, value):
+                self.updates.append((resource, value))
+
+        handler = Handler()
+        for value in range(100):
+            handler.oneway.update_resource("a", value)
+            handler.oneway.update_resource("b", -value)
+        self.assertEqual(handler._requests.qsize(), 2)
+        handler.process()
+        self.assertEqual(handler.updates, [("a", 99), ("b", -99)])
+
+        # once processed, new calls get queued again
+        handler.oneway.update_resource("a", 100)
+        handler.process()
+        self.assertEqual(handler.updates[-1], ("a", 100))
+        self.assertFalse(handler._coalesced)
+
+    def test_priority(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__(prioritized=True)
+                self.calls = []
+
+            @priority(LOW_PRIORITY)
+            def telemetry(self, value):
+                self.calls.append(('telemetry', value))
+
+            def update(self, value):
+                self.calls.append(('update', value))
+
+        handler = Handler()
+        handler.oneway.telemetry(1)
+        handler.oneway.update(1)
+        handler.oneway.telemetry(2)
+        handler.oneway(priority=HIGH_PRIORITY).telemetry(3)
+        handler.oneway.update(2)
+        handler.process()
+        self.assertEqual(handler.calls, [('telemetry', 3),
+                                         ('update', 1),
+                                         ('update', 2),
+                                         ('telemetry', 1),
+                                         ('telemetry', 2)])
+
+        spawn(handler.process, forever=True)
+        handler.oneway.telemetry(4)
+        handler.oneway.update(3)
+        handler.sync(priority=HIGH_PRIORITY).update(4)
+        self.assertEqual(handler.calls[-3:], [('update', 4),
+                                              ('update', 3),
+                                              ('telemetry', 4)])
+        handler.stop_processing()
+
+        # stopping waits for the calls queued beforehand, whatever their
+        # priority
+        handler = Handler()
+        handler.oneway.telemetry(1)
+        handler.oneway.update(2)
+        handler.stop_processing()
+        handler.process(forever=True)
+        self.assertEqual(handler.calls, [('update', 2), ('telemetry', 1)])
+
+    def test_overflow(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self, **kwargs):
+                super(Handler, self).__init__(maxsize=2, **kwargs)
+                self.values = []
+
+            def store(self, value):
+                self.values.append(value)
+
+        handler = Handler(overflow=OVERFLOW_DROP_NEWEST)
+        for value in range(4):
+            handler.oneway.store(value)
+        self.assertRaises(QueueFull, handler.sync.store, 4)
+        handler.process()
+        self.assertEqual(handler.values, [0, 1])
+        self.assertEqual(handler.overflow_counts,
+                         dict(dropped_newest=2, rejected=1))
+
+        handler = Handler(overflow=OVERFLOW_DROP_OLDEST)
+        for value in range(4):
+            handler.oneway.store(value)
+        handler.process()
+        self.assertEqual(handler.values, [2, 3])
+        self.assertEqual(handler.overflow_counts, dict(dropped_oldest=2))
+
+        handler = Handler(overflow=OVERFLOW_RAISE)
+        handler.oneway.store(0)
+        handler.oneway.store(1)
+        self.assertRaises(QueueFull, handler.oneway.store, 2)
+        self.assertEqual(handler.overflow_counts, dict(rejected=1))
+
+        handler = Handler(overflow=OVERFLOW_BLOCK_TIMEOUT, put_timeout=.01)
+        handler.oneway.store(0)
+        handler.oneway.store(1)
+        self.assertRaises(QueueFull, handler.oneway.store, 2)
+        self.assertEqual(handler.overflow_counts,
+                         dict(blocked=1, timed_out=1))
+
+        handler = Handler(overflow=OVERFLOW_BLOCK)
+        spawn(handler.process, forever=True)
+        for value in range(10):
+            handler.oneway.store(value)
+        handler.sync.store(10)
+        self.assertEqual(handler.values, range(11))
+        self.assertTrue(handler.overflow_counts['blocked'] > 0)
+        handler.stop_processing()
+
+    def test_deferred(self):
+        class Kaboom(Exception):
+            pass
+
+        class Handler(DeferredCallHandler):
+            def double(self, value):
+                return value * 2
+
+            def kaboom(self):
+                raise Kaboom()
+
+        handler = Handler()
+        futures = [handler.deferred.double(value) for value in range(100)]
+        self.assertFalse(any(future.ready() for future in futures))
+        self.assertRaises(Timeout, wait_all, futures, timeout=.01)
+
+        spawn(handler.process, forever=True)
+        self.assertEqual(wait_all(futures), [value * 2
+                                             for value in range(100)])
+        self.assertTrue(all(future.successful() for future in futures))
+
+        future = handler.deferred.kaboom()
+        self.assertRaises(Kaboom, future.get)
+        self.assertIsInstance(future.exception, Kaboom)
+
+        slow = handler.deferred.double(21)
+        self.assertIs(wait_any([slow]), slow)
+        self.assertEqual(slow.get(), 42)
+        handler.stop_processing()
+
+    def test_deferred_cancel(self):
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__()
+                self.executed = False
+
+            def do_something(self):
+                self.executed = True
+
+        handler = Handler()
+        future = handler.deferred.do_something()
+        # a timed out get doesn't give up on the call
+        self.assertRaises(Timeout, future.get, timeout=.01)
+        waiter = spawn(future.get)
+        sleep()
+        self.assertTrue(future.cancel())
+        self.assertRaises(CallCancelled, waiter.get)
+        handler.process()
+        self.assertFalse(handler.executed)
+        self.assertEqual(handler.cancelled_count, 1)
+
+    def test_deferred_cancel_running(self):
+        class Handler(DeferredCallHandler):
+            def slow(self):
+                sleep(.01)
+                return 42
+
+        handler = Handler()
+        future = handler.deferred.slow()
+        processor = spawn(handler.process)
+        sleep()
+        self.assertTrue(future.cancel())
+        self.assertRaises(CallCancelled, wait_all, [future])
+        processor.join()
+        # the late result doesn't override the cancellation
+        self.assertFalse(future.successful())
+        self.assertRaises(CallCancelled, future.get)
+
+    def _offloading_handler(self, **offload_options):
+        blocking_sleep = get_original('time', 'sleep')
+
+        class Handler(DeferredCallHandler):
+            def __init__(self):
+                super(Handler, self).__init__()
+                self.calls = []
+
+            @offload(**offload_options)
+            def crunch(self, value):
+                self.calls.append(('start', value))
+                blocking_sleep(.05)
+                self.calls.append(('end', value))
+                return value * 2
+
+        return Handler()
+
+    def test_offload(self):
+        ticks = []
+
+        def ticker():
+            while True:
+                ticks.append(None)
+                sleep(.005)
+
+        handler = self._offloading_handler()
+        spawn(handler.process, forever=True)
+        clock = spawn(ticker)
+        futures = [handler.deferred.crunch(value) for value in range(2)]
+        self.assertEqual(wait_all(futures), [0, 2])
+        self.assertEqual(handler.sync.crunch(2), 4)
+        clock.kill()
+        handler.stop_processing()
+
+        # the hub kept running, and calls didn't overlap
+        self.assertTrue(len(ticks) > 5)
+        self.assertEqual(handler.calls, [('start', 0), ('end', 0),
+                                         ('start', 1), ('end', 1),
+                                         ('start', 2), ('end', 2)])
+
+    def test_offload_unserialized(self):
+        handler = self._offloading_handler(serialized=False)
+        spawn(handler.process, forever=True)
+        futures = [handler.deferred.crunch(value) for value in range(2)]
+        self.assertEqual(wait_all(futures), [0, 2])
+        handler.stop_processing()
+        self.assertEqual(sorted(handler.calls[:2]),
+                         [('start', 0), ('start', 1)])
+
+    def test_offload_executor(self):
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            self.skipTest("concurrent.futures is not available")
+        executor = ThreadPoolExecutor(2)
+        handler = self._offloading_handler(executor=executor)
+        spawn(handler.process, forever=True)
+        self.assertEqual(handler.sync(timeout=1).crunch(21), 42)
+        handler.stop_processing()
+        executor.shutdown()
@@ -0,0 +1,95 @@
+from gevent import sleep, spawn, Timeout
+from gevent.monkey import get_original
+from unittest2 import TestCase
+from async import DeferredCallHandler, MetricsAggregator, prometheus_text
+from async import offload, wait_all
+from async import QueueFull, OVERFLOW_DROP_NEWEST
+
+
+class _Handler(DeferredCallHandler):
+    def noop(self):
+        pass
+
+    def fail(self):
+        raise ValueError()
+
+    def slow(self):
+        sleep(.05)
+
+    @offload(serialized=False)
+    def crunch(self, value):
+        get_original('time', 'sleep')(.05)
+        if value is None:
+            raise ValueError()
+
+
+class TestMetrics(TestCase):
+
+    def test_counters(self):
+        metrics = MetricsAggregator()
+        handler = _Handler(metrics=metrics)
+        processor = spawn(handler.process, forever=True)
+        handler.sync.noop()
+        self.assertRaises(ValueError, handler.sync.fail)
+        handler.oneway.fail()
+        handler.oneway.slow()
+        self.assertRaises(Timeout, handler.sync(timeout=.01).noop)
+        handler.sync.noop()
+        handler.stop_processing()
+        processor.join()
+
+        noop = metrics.methods['noop']
+        self.assertEqual((noop.enqueued, noop.executed, noop.timed_out),
+                         (3, 2, 1))
+        fail = metrics.methods['fail']
+        self.assertEqual((fail.enqueued, fail.executed, fail.failed),
+                         (2, 2, 2))
+        slow = metrics.methods['slow']
+        self.assertEqual(slow.duration.count, 1)
+        self.assertTrue(slow.duration.sum >= .05)
+        # the call after the slow one waited for it
+        self.assertTrue(noop.wait.sum >= .03)
+        self.assertEqual(metrics.depth, 0)
+        self.assertEqual(metrics.max_depth, 3)
+
+    def test_unserialized_offload(self):
+        metrics = MetricsAggregator()
+        handler = _Handler(metrics=metrics)
+        futures = [handler.deferred.crunch(1), handler.deferred.crunch(None)]
+        handler.process()
+        # measured once done rather than when the handler moved on
+        crunch = metrics.methods['crunch']
+        self.assertEqual(crunch.executed, 0)
+        self.assertRaises(ValueError, wait_all, futures, timeout=1)
+        sleep(.01)
+        self.assertEqual((crunch.executed, crunch.failed), (2, 1))
+        self.assertTrue(crunch.duration.sum >= .1)
+
+    def test_dropped(self):
+        metrics = MetricsAggregator()
+        handler = _Handler(maxsize=1, overflow=OVERFLOW_DROP_NEWEST,
+                           metrics=metrics)
+        handler.oneway.noop()
+        handler.oneway.noop()
+        self.assertRaises(QueueFull, handler.sync.noop)
+        handler.process(batched=True)
+        noop = metrics.methods['noop']
+        self.assertEqual((noop.enqueued, noop.dropped, noop.executed),
+                         (1, 2, 1))
+
+    def test_prometheus_text(self):
+        metrics = MetricsAggregator(buckets=(.1, 1))
+        handler = _Handler(metrics=metrics)
+        handler.oneway.noop()
+        handler.process()
+        text = prometheus_text({'manager': metrics})
+        self.assertIn('# TYPE async_calls_executed_total counter\n'
+                      'async_calls_executed_total'
+                      '{handler="manager",method="noop"} 1\n', text)
+        self.assertIn('async_queue_max_depth{handler="manager"} 1\n', text)
+        self.assertIn('async_call_duration_seconds_bucket'
+                      '{handler="manager",le="+Inf",method="noop"} 1\n', text)
+        self.assertIn('async_call_wait_seconds_count'
+                      '{handler="manager",method="noop"} 1\n', text)
+        self.assertIn('async_queue_depth{handler="a\\"b"}',
+                      prometheus_text({'a"b': MetricsAggregator()}))
@@ -0,0 +1,52 @@
+from gevent import sleep, Timeout
+from unittest2 import TestCase
+from async import DeferredCallHandler, HandlerPool
+
+
+class _Handler(DeferredCallHandler):
+    def __init__(self):
+        super(_Handler, self).__init__()
+        self.resources = {}
+
+    def update(self, resource, value):
+        self.resources.setdefault(resource, []).append(value)
+
+    def get(self, resource):
+        return self.resources.get(resource, [])
+
+    def slow(self, resource):
+        sleep(.3)
+
+
+class TestHandlerPool(TestCase):
+
+    def setUp(self):
+        self.pool = HandlerPool(_Handler, 4, key=lambda resource, *_: resource)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.stop(timeout=1)
+
+    def test_routing(self):
+        for value in range(10):
+            for resource in range(8):
+                self.pool.oneway.update(resource, value)
+
+        for resource in range(8):
+            self.assertEqual(self.pool.sync.get(resource), range(10))
+            handler = self.pool.shard(resource)
+            self.assertIn(resource, handler.resources)
+            for other in self.pool.handlers:
+                if other is not handler:
+                    self.assertNotIn(resource, other.resources)
+
+        future = self.pool.deferred.get(0)
+        self.assertEqual(future.get(), range(10))
+
+    def test_concurrency(self):
+        busy = 0
+        idle = next(resource for resource in range(1, 8)
+                    if self.pool.shard(resource) is not self.pool.shard(busy))
+        self.pool.oneway.slow(busy)
+        self.pool.sync(timeout=.1).update(idle, 1)
+        self.assertRaises(Timeout, self.pool.sync(timeout=.1).get, busy)
@@ -0,0 +1,78 @@
+import os
+import threading
+import gevent
+from unittest2 import TestCase
+from async import ProcessHandlerPool, RemoteError, wait_all
+
+
+class Kaboom(Exception):
+    pass
+
+
+class _Handler(object):
+    def __init__(self):
+        self.values = []
+
+    def pid(self):
+        return os.getpid()
+
+    def nap(self, value):
+        gevent.sleep(.01)
+        return value
+
+    def store(self, value):
+        self.values.append(value)
+
+    def stored(self, key=None):
+        return self.values
+
+    def kaboom(self):
+        raise Kaboom("oh no")
+
+    def unpicklable(self):
+        return threading.Lock()
+
+
+class TestProcessHandlerPool(TestCase):
+
+    def test_calls(self):
+        pool = ProcessHandlerPool(_Handler)
+        try:
+            self.assertNotEqual(pool.sync.pid(), os.getpid())
+            for value in range(10):
+                pool.oneway.store(value)
+            self.assertEqual(pool.sync(timeout=1).stored(), range(10))
+            self.assertEqual(pool.deferred.stored().get(), range(10))
+            self.assertRaises(Kaboom, pool.sync.kaboom)
+            self.assertRaises(RemoteError, pool.sync.unpicklable)
+            # the worker survives failures
+            self.assertEqual(len(pool.sync.stored()), 10)
+        finally:
+            pool.close()
+
+        self.assertRaises(RemoteError, pool.sync.pid)
+
+    def test_sharding(self):
+        pool = ProcessHandlerPool(_Handler, 3)
+        try:
+            pids = wait_all(pool.deferred.pid() for _ in range(6))
+            self.assertEqual(len(set(pids)), 3)
+        finally:
+            pool.close()
+
+        pool = ProcessHandlerPool(_Handler, 3, key=lambda value: value % 2)
+        try:
+            for value in range(10):
+                pool.oneway.store(value)
+            self.assertEqual(pool.sync.stored(0), range(0, 10, 2))
+        finally:
+            pool.close()
+
+    def test_handler_yielding(self):
+        # the workers don't get to run the greenlets of their parent
+        pool = ProcessHandlerPool(_Handler, 3, key=lambda value: value % 3)
+        try:
+            futures = [pool.deferred.nap(value) for value in range(40)]
+            self.assertEqual(wait_all(futures, timeout=5), range(40))
+        finally:
+            pool.close()
@@ -0,0 +1,233 @@
+import gevent
+from gevent.queue import Empty
+from unittest2 import TestCase
+from async import Event, EventQueue, PriorityEventQueue
+from async import LOW_PRIORITY, HIGH_PRIORITY
+
+
+class _Item(object):
+    def __init__(self, name, priority=None):
+        self.name = name
+        if priority is not None:
+            self.priority = priority
+
+    def __repr__(self):
+        return self.name
+
+
+class TestEventQueue(TestCase):
+
+    def test_batches(self):
+        queue = EventQueue()
+        for index in range(5):
+            queue.put(index)
+        queue.put(StopIteration)
+        queue.put(5)
+        self.assertEqual(list(queue.batches(max_size=2)),
+                         [[0, 1], [2, 3], [4]])
+        # whatever follows the end marker stays queued
+        self.assertEqual(queue.get_nowait(), 5)
+
+    def test_get_matching(self):
+        queue = EventQueue(indexed=True)
+        for name in ['a', 'b', 'a', 'c', 'b']:
+            queue.put(_Item(name))
+        self.assertEqual(queue.get_matching('c').name, 'c')
+        first_b = queue.get_matching('b', 'c')
+        self.assertEqual(len(queue), 3)
+        self.assertEqual([item.name for item in queue.queue], ['a', 'a', 'b'])
+        self.assertIsNot(queue.get_matching('b'), first_b)
+        self.assertEqual([queue.get().name for _ in range(2)], ['a', 'a'])
+        self.assertTrue(queue.empty())
+        self.assertRaises(Empty, queue.get_matching, 'a', timeout=.01)
+
+    def test_get_matching_events(self):
+        queue = EventQueue(indexed=True)
+        queue.put(Event('ping', 1))
+        queue.put(StopIteration)
+        queue.put(Event('pong', 2))
+        self.assertEqual(queue.get_matching('pong').name, 'pong')
+        self.assertIs(queue.get_matching(StopIteration), StopIteration)
+        self.assertTrue(queue.get().match('ping'))
+
+    def test_get_matching_waits(self):
+        queue = EventQueue(indexed=True)
+
+        def put():
+            queue.put(_Item('a'))
+            gevent.sleep(.01)
+            queue.put(_Item('b'))
+
+        gevent.spawn(put)
+        self.assertEqual(queue.get_matching('b', timeout=1).name, 'b')
+        self.assertEqual(queue.get_nowait().name, 'a')
+
+    def test_get_matching_wakes_putters(self):
+        queue = EventQueue(1, indexed=True)
+        queue.put(_Item('a'))
+        putter = gevent.spawn(queue.put, _Item('b'))
+        gevent.sleep()
+        self.assertEqual(queue.get_matching('a').name, 'a')
+        putter.join(timeout=1)
+        self.assertEqual(queue.get_nowait().name, 'b')
+
+    def test_get_matching_unindexed(self):
+        queue = EventQueue()
+        self.assertRaises(ValueError, queue.get_matching, 'a')
+        for name in ['a', 'b', 'a']:
+            queue.put(_Item(name))
+        self.assertEqual(queue.get_matching('b', block=False).name, 'b')
+        self.assertRaises(Empty, queue.get_matching, 'c', block=False)
+        self.assertEqual([queue.get().name for _ in range(2)], ['a', 'a'])
+
+        queue = PriorityEventQueue()
+        for item in [_Item('a'), _Item('b', HIGH_PRIORITY),
+                     _Item('a', HIGH_PRIORITY)]:
+            queue.put(item)
+        # in the order the queue is served
+        self.assertEqual(queue.get_matching('a', block=False).priority,
+                         HIGH_PRIORITY)
+        self.assertEqual([queue.get().name for _ in range(2)], ['b', 'a'])
+
+    def test_remove_first_indexed(self):
+        queue = EventQueue(indexed=True)
+        for name in ['a', 'b', 'a']:
+            queue.put(_Item(name))
+        item = queue.remove_first(lambda item: item.name == 'b')
+        self.assertEqual(item.name, 'b')
+        self.assertEqual(queue.get_matching('a', 'b').name, 'a')
+        self.assertEqual(len(queue), 1)
+
+    def test_remove_first_requeued(self):
+        # a copy put back after one was taken out of order is still queued
+        queue = EventQueue(indexed=True)
+        tick = _Item('tick')
+        queue.put(_Item('update'))
+        queue.put(tick)
+        self.assertIs(queue.get_matching('tick'), tick)
+        queue.put(tick)
+        self.assertIs(queue.remove_first(lambda item: item.name == 'tick'),
+                      tick)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.get().name, 'update')
+        self.assertTrue(queue.empty())
+
+    def test_get_all_matching(self):
+        for indexed in [False, True]:
+            queue = EventQueue(indexed=indexed)
+            for item in [_Item('a'), _Item('b'), _Item('a'), StopIteration,
+                         _Item('a'), _Item('c')]:
+                queue.put(item)
+            events = queue.get_all_matching('a', StopIteration)
+            self.assertEqual([item.name for item in events[:2]], ['a', 'a'])
+            self.assertIs(events[2], StopIteration)
+            self.assertEqual([item.name for item in queue.queue],
+                             ['b', 'a', 'c'])
+            self.assertEqual(queue.get_all_matching('d'), [])
+
+    def test_get_all_matching_since(self):
+        for queue in [EventQueue(), PriorityEventQueue()]:
+            queue.put(_Item('a'))
+            queue.put(_Item('b'))
+            mark = queue.mark()
+            queue.put(_Item('a', HIGH_PRIORITY))
+            queue.put(_Item('c'))
+            # only the items queued since the mark are gone through
+            events = queue.get_all_matching('a', since=mark)
+            self.assertEqual([item.priority for item in events],
+                             [HIGH_PRIORITY])
+            mark = queue.mark()
+            queue.remove_first(lambda item: item.name == 'c')
+            # unless the mark left the queue
+            self.assertEqual(len(queue.get_all_matching('a', since=mark)), 1)
+            self.assertEqual([item.name for item in queue.queue], ['b'])
+
+    def test_get_all_matching_bounded(self):
+        queue = EventQueue(2)
+        queue.put(_Item('a'))
+        queue.put(_Item('b'))
+        putter = gevent.spawn(queue.put, _Item('c'))
+        gevent.sleep()
+        self.assertEqual(len(queue.get_all_matching('a')), 1)
+        putter.join(timeout=1)
+        self.assertTrue(putter.successful())
+        self.assertEqual([item.name for item in queue.queue], ['b', 'c'])
+
+    def test_get_matching_releases_items(self):
+        # items taken out of order don't pile up behind one left queued
+        queue = EventQueue(10, indexed=True)
+        queue.put(_Item('update'))
+        for _ in range(1000):
+            queue.put(_Item('setup'))
+            self.assertEqual(queue.get_matching('setup').name, 'setup')
+        self.assertLessEqual(len(queue.queue._items), 2)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.get().name, 'update')
+        self.assertTrue(queue.empty())
+
+
+class TestPriorityEventQueue(TestCase):
+
+    def test_priority_order(self):
+        queue = PriorityEventQueue()
+        for item in [_Item('low1', LOW_PRIORITY), _Item('normal1'),
+                     _Item('high1', HIGH_PRIORITY),
+                     _Item('low2', LOW_PRIORITY),
+                     _Item('high2', HIGH_PRIORITY), _Item('normal2')]:
+            queue.put(item)
+        self.assertEqual(len(queue), 6)
+        self.assertEqual(queue.peek().name, 'high1')
+        self.assertEqual([queue.get().name for _ in range(6)],
+                         ['high1', 'high2', 'normal1', 'normal2',
+                          'low1', 'low2'])
+        self.assertTrue(queue.empty())
+
+    def test_starvation_limit(self):
+        queue = PriorityEventQueue(starvation_limit=3)
+        queue.put(_Item('low', LOW_PRIORITY))
+        for index in range(10):
+            queue.put(_Item('high{}'.format(index), HIGH_PRIORITY))
+        names = [queue.get().name for _ in range(11)]
+        self.assertEqual(names.index('low'), 3)
+
+    def test_end_marker_last(self):
+        queue = PriorityEventQueue(starvation_limit=1)
+        queue.put(_Item('low', LOW_PRIORITY))
+        queue.put(StopIteration)
+        queue.put(_Item('high', HIGH_PRIORITY))
+        self.assertEqual([item.name for item in queue.all()],
+                         ['high', 'low'])
+        self.assertTrue(queue.empty())
+
+    def test_get_matching(self):
+        queue = PriorityEventQueue(indexed=True)
+        for item in [_Item('a', LOW_PRIORITY), _Item('b', HIGH_PRIORITY),
+                     _Item('a', HIGH_PRIORITY), _Item('c')]:
+            queue.put(item)
+        # served by priority, like get()
+        self.assertEqual(queue.get_matching('a').priority, HIGH_PRIORITY)
+        self.assertEqual([queue.get().name for _ in range(3)],
+                         ['b', 'c', 'a'])
+        self.assertRaises(Empty, queue.get_matching, 'a', timeout=0)
+
+    def test_get_matching_starvation(self):
+        queue = PriorityEventQueue(starvation_limit=1, indexed=True)
+        for priority in [LOW_PRIORITY, HIGH_PRIORITY, HIGH_PRIORITY]:
+            queue.put(_Item('a', priority))
+        queue.put(_Item('b', LOW_PRIORITY))
+        self.assertEqual([queue.get_matching('a').priority for _ in range(3)],
+                         [HIGH_PRIORITY, LOW_PRIORITY, HIGH_PRIORITY])
+        self.assertEqual(queue.get().name, 'b')
+
+    def test_index_releases_items(self):
+        # served by priority rather than in order, which leaves entries
+        # behind in the index
+        queue = PriorityEventQueue(starvation_limit=None, indexed=True)
+        queue.put(_Item('a', LOW_PRIORITY))
+        for _ in range(1000):
+            queue.put(_Item('a', HIGH_PRIORITY))
+            self.assertEqual(queue.get().priority, HIGH_PRIORITY)
+        self.assertLessEqual(sum(len(lane)
+                                 for lane in queue.queue._lanes.values()), 2)
+        self.assertEqual(queue.get_matching('a').priority, LOW_PRIORITY)
+        self.assertTrue(queue.empty())
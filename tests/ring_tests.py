@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import gevent
+from gevent import sleep, spawn
+from unittest2 import TestCase
+from async import DeferredCallHandler, RingProducer, RingConsumer
+from async import OVERFLOW_RAISE
+from async.call import _SyncCall
+from async.ring import _HEAD
+
+
+class _Handler(DeferredCallHandler):
+    def __init__(self, **kwargs):
+        super(_Handler, self).__init__(**kwargs)
+        self.updates = []
+
+    def update(self, resource, value=None):
+        self.updates.append((resource, value))
+
+
+class TestRing(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ring')
+        self.handler = _Handler()
+        self.processor = spawn(self.handler.process, forever=True)
+
+    def tearDown(self):
+        self.handler.stop_processing()
+        self.processor.join()
+        shutil.rmtree(self.directory)
+
+    def test_calls(self):
+        consumer = RingConsumer(self.path, self.handler, capacity=256)
+        consumer.start()
+        producer = RingProducer(self.path)
+        try:
+            for index in range(1000):
+                producer.oneway.update(u'r\xe9source', value=[index, 'x'])
+                if index % 7 == 0:
+                    sleep(.001)
+            self.assertRaises(TypeError, producer.add_request,
+                              _SyncCall('update', 'resource'))
+            with gevent.Timeout(1):
+                while len(self.handler.updates) + producer.dropped < 1000:
+                    sleep(.01)
+        finally:
+            producer.close()
+            consumer.stop()
+        self.assertTrue(len(self.handler.updates) > 100)
+        self.assertEqual(self.handler.updates[0], (u'r\xe9source', [0, 'x']))
+        values = [value[0] for _, value in self.handler.updates]
+        self.assertEqual(values, sorted(values))
+
+    def test_across_processes(self):
+        consumer = RingConsumer(self.path, self.handler)
+        consumer.start()
+        try:
+            pid = gevent.fork()
+            if pid == 0:
+                try:
+                    producer = RingProducer(self.path)
+                    for index in range(10000):
+                        producer.oneway.update(index)
+                        if index % 1000 == 0:
+                            sleep(.01)
+                finally:
+                    os._exit(0)
+            gevent.os.waitpid(pid, 0)
+            with gevent.Timeout(2):
+                while len(self.handler.updates) < 10000:
+                    sleep(.01)
+        finally:
+            consumer.stop()
+        self.assertEqual(self.handler.updates,
+                         [(index, None) for index in range(10000)])
+
+    def test_refused_calls(self):
+        handler = _Handler(maxsize=2, overflow=OVERFLOW_RAISE)
+        consumer = RingConsumer(self.path, handler)
+        producer = RingProducer(self.path)
+        try:
+            for index in range(5):
+                producer.oneway.update(index)
+            self.assertEqual(consumer.drain(), 5)
+            self.assertEqual(consumer.dropped, 3)
+            self.assertEqual(consumer._get(_HEAD), consumer._head)
+            handler.process()
+            producer.oneway.update(5)
+            self.assertEqual(consumer.drain(), 1)
+            handler.process()
+        finally:
+            producer.close()
+            consumer.close()
+        self.assertEqual(handler.updates,
+                         [(0, None), (1, None), (5, None)])
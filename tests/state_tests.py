@@ -1,12 +1,17 @@
-from gevent import sleep, monkey
+from gevent import sleep, monkey, getcurrent
 monkey.patch_all()
 from unittest2 import TestCase
 from async.state import state, StateValidationError, StateMachine
+from async.state import state_machine, state_statistics, State
+from async.state import StateRegistry
 from contextlib import contextmanager
 import mock
 import collections
+import gc
 import itertools
+import types
 import logging
+import weakref
 from Queue import Queue, Empty
 
 
@@ -184,3 +189,411 @@ class TestState(TestCase):
         obj.a_state(store=False)
         sleep()
         self.assertIsNone(obj.state)
+
+    def test_trampoline(self):
+        class Object(object):
+            def __init__(self):
+                self.count = 0
+                self.greenlets = set()
+
+            @state(transitions_to="bar", trampoline=True)
+            def foo(self):
+                self.greenlets.add(getcurrent())
+                self.bar()
+
+            @state(transitions_to="foo")
+            def bar(self):
+                self.greenlets.add(getcurrent())
+                if self.count < 100:
+                    self.count += 1
+                    return self.foo()
+
+        with self.transition_tracking() as transition_map:
+            obj = Object()
+            obj.foo()
+
+            self.assertEqual(len(transition_map), 1)
+            state_machine, transition_queue = transition_map.items()[0]
+            self.assertTransitions(
+                state_machine,
+                [None] + ['foo', 'bar'] * (1 + 100),
+                transition_queue)
+            self.assertTrue(state_machine.successful())
+            self.assertEqual(obj.count, 100)
+            # a single greenlet ran all the states
+            self.assertEqual(len(obj.greenlets), 1)
+
+    def test_trampoline_wrong_transition(self):
+        class Object(object):
+            def __init__(self):
+                self.after_transition = False
+
+            @state(transitions_to="second", trampoline=True)
+            def initial(self):
+                self.second()
+
+            @state()
+            def second(self):
+                self.third()
+                self.after_transition = True
+
+            @state
+            def third(self):
+                pass
+
+        obj = Object()
+        state_machine = obj.initial()
+        state_machine.join(timeout=.1)
+        self.assertFalse(state_machine.successful())
+        self.assertIsInstance(state_machine.exception, StateValidationError)
+        self.assertFalse(obj.after_transition)
+
+    def test_trampoline_control_flow(self):
+        # the code following a transition doesn't run, like with regular
+        # machines
+        class Object(object):
+            def __init__(self):
+                self.log = []
+
+            @state(transitions_to=["second", "third"], trampoline=True)
+            def initial(self):
+                try:
+                    self.second()
+                except Exception:
+                    self.log.append('caught')
+                self.log.append('initial')
+                self.third()
+
+            @state
+            def second(self):
+                self.log.append('second')
+
+            @state
+            def third(self):
+                pass
+
+        obj = Object()
+        state_machine = obj.initial()
+        state_machine.join(timeout=.1)
+        self.assertTrue(state_machine.successful())
+        self.assertEqual(obj.log, ['second'])
+        self.assertEqual(state_machine._state.name, 'second')
+
+    def test_resolved_transitions(self):
+        @state_machine
+        class Object(object):
+            @state(transitions_to="second")
+            def initial(self):
+                self.second()
+
+            @state
+            def second(self):
+                pass
+
+        initial, second = Object.initial.state, Object.second.state
+        self.assertEqual(initial.targets, frozenset([second]))
+        initial.validate_transition(second)
+        self.assertRaises(StateValidationError,
+                          second.validate_transition, initial)
+
+        class Subclass(Object):
+            @state
+            def second(self):
+                pass
+
+        # a subclass may still override the target of a transition
+        initial.validate_transition(Subclass.second.state)
+
+    def test_unresolved_transitions(self):
+        def decorate(function):
+            # states declared through a helper
+            return state(function, transitions_to="second")
+
+        class Object(object):
+            @decorate
+            def initial(self):
+                self.second()
+
+            @state
+            def second(self):
+                pass
+
+        # names are compared until resolved
+        machine = Object().initial()
+        sleep()
+        machine.join(timeout=1)
+        self.assertTrue(machine.successful())
+        self.assertEqual(machine._state.name, 'second')
+        self.assertRaises(StateValidationError,
+                          Object.second.state.validate_transition,
+                          Object.initial.state)
+
+        state_machine(Object)
+        self.assertEqual(Object.initial.state.targets,
+                         frozenset([Object.second.state]))
+
+    def test_unknown_transition(self):
+        with self.assertRaises(StateValidationError):
+            @state_machine
+            class Object(object):
+                @state(transitions_to=["second", "thrid"])
+                def initial(self):
+                    self.second()
+
+                @state
+                def second(self):
+                    pass
+
+    def test_inherited_transition(self):
+        class Base(object):
+            @state
+            def final(self):
+                pass
+
+        @state_machine
+        class Object(Base):
+            @state(transitions_to="final")
+            def initial(self):
+                self.final()
+
+        self.assertEqual(Object.initial.state.targets,
+                         frozenset([Base.final.state]))
+
+    def test_transition_logging(self):
+        class Object(object):
+            @state(transitions_to="second")
+            def initial(self):
+                self.second()
+
+            @state
+            def second(self):
+                pass
+
+        class Recorder(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record)
+
+        logger = logging.getLogger('async.state')
+        recorder = Recorder()
+        logger.addHandler(recorder)
+        self.addCleanup(logger.removeHandler, recorder)
+        self.addCleanup(logger.setLevel, logger.level)
+
+        logger.setLevel(logging.DEBUG)
+        state_machine = Object().initial()
+        sleep()
+        state_machine.join(timeout=.01)
+        self.assertEqual(
+            [(record.from_state and record.from_state.name,
+              record.to_state.name) for record in recorder.records],
+            [(None, 'initial'), ('initial', 'second')])
+        self.assertIs(recorder.records[0].state_machine, state_machine)
+
+        # nothing gets formatted unless the logger is enabled
+        logger.setLevel(logging.INFO)
+        with mock.patch.object(State, '__repr__') as state_repr:
+            state_machine = Object().initial()
+            sleep()
+            state_machine.join(timeout=.01)
+        self.assertFalse(state_repr.called)
+        self.assertEqual(len(recorder.records), 2)
+
+        # levels set elsewhere are picked up as machines start
+        logger.setLevel(logging.NOTSET)
+        parent = logging.getLogger('async')
+        self.addCleanup(parent.setLevel, parent.level)
+        parent.setLevel(logging.DEBUG)
+        state_machine = Object().initial()
+        sleep()
+        state_machine.join(timeout=.01)
+        self.assertEqual(len(recorder.records), 4)
+
+        # and by running machines after a few transitions, the logger
+        # being left alone
+        class PingPong(object):
+            @state(transitions_to=['pong'], trampoline=True)
+            def ping(self, count):
+                if count == 600:
+                    parent.setLevel(logging.DEBUG)
+                if count:
+                    self.pong(count - 1)
+
+            @state(transitions_to=['ping'])
+            def pong(self, count):
+                if count:
+                    self.ping(count - 1)
+
+        self.assertNotIn('setLevel', vars(logger))
+        parent.setLevel(logging.INFO)
+        del recorder.records[:]
+        state_machine = PingPong().ping(1000)
+        state_machine.join(timeout=1)
+        self.assertTrue(600 - 256 <= len(recorder.records) <= 600)
+
+    def test_history(self):
+        class Object(object):
+            @state(transitions_to="second", history=2)
+            def initial(self, count):
+                self.second(count)
+
+            @state(transitions_to=["initial", "final"])
+            def second(self, count):
+                if count:
+                    self.initial(count - 1)
+                self.final()
+
+            @state
+            def final(self):
+                sleep(1)
+
+        state_machine = Object().initial(2)
+        sleep(.01)
+        history = list(state_machine.history)
+        # only the last transitions are kept
+        self.assertEqual(
+            [(transition.from_state.name, transition.to_state.name)
+             for transition in history],
+            [('initial', 'second'), ('second', 'final')])
+        self.assertLessEqual(history[0].timestamp, history[1].timestamp)
+        self.assertGreaterEqual(history[1].dwell, 0)
+
+        statistics = state_statistics()
+        self.assertEqual(
+            statistics.edges[Object.second.state, Object.final.state], 1)
+        self.assertEqual(statistics.dwell[Object.second.state].count, 1)
+        self.assertEqual(statistics.current[Object.final.state].count, 1)
+        state_machine._state_greenlet.kill()
+
+    def test_no_history(self):
+        class Object(object):
+            @state
+            def initial(self):
+                pass
+
+        state_machine = Object().initial()
+        state_machine.join()
+        self.assertIsNone(state_machine.history)
+
+    def test_trampoline_history(self):
+        class Object(object):
+            @state(transitions_to="second", trampoline=True, history=8)
+            def initial(self):
+                self.second()
+
+            @state
+            def second(self):
+                pass
+
+        state_machine = Object().initial()
+        state_machine.join()
+        self.assertEqual(
+            [(transition.from_state and transition.from_state.name,
+              transition.to_state.name)
+             for transition in state_machine.history],
+            [(None, 'initial'), ('initial', 'second')])
+        # finished machines aren't counted as being in their last state
+        statistics = state_statistics()
+        self.assertEqual(
+            statistics.edges[Object.initial.state, Object.second.state], 1)
+        self.assertNotIn(Object.second.state, statistics.current)
+
+    def test_registry(self):
+        registry = StateRegistry()
+
+        class Object(object):
+            def __init__(self):
+                self.proceed = Queue()
+
+            @state(transitions_to="second", registry=registry)
+            def initial(self):
+                self.proceed.get()
+                self.second()
+
+            @state
+            def second(self):
+                self.proceed.get()
+
+        objects = [Object() for _ in xrange(3)]
+        machines = [obj.initial() for obj in objects]
+        sleep()
+        self.assertEqual(registry.count(Object.initial), 3)
+        self.assertEqual(registry.count(Object.second), 0)
+
+        objects[0].proceed.put(None)
+        sleep(.01)
+        self.assertEqual(registry.snapshot(), {Object.initial.state: 2,
+                                               Object.second.state: 1})
+        self.assertEqual(registry.machines(Object.second), [machines[0]])
+
+        # finished machines are forgotten, even while still referenced
+        objects[0].proceed.put(None)
+        machines[0].join()
+        self.assertEqual(registry.snapshot(), {Object.initial.state: 2})
+        self.assertEqual(len(registry), 2)
+
+        # and so are killed machines, once the hub notified their links
+        for machine in machines[1:]:
+            machine._state_greenlet.kill()
+        sleep()
+        self.assertEqual(registry.snapshot(), {})
+
+        # even before they started
+        machine = Object().initial()
+        self.assertEqual(len(registry), 1)
+        machine._state_greenlet.kill()
+        sleep()
+        self.assertEqual(registry.snapshot(), {})
+        self.assertEqual(len(registry), 0)
+
+        # the registry doesn't keep machines alive
+        reference = weakref.ref(machines[0])
+        del objects, machines, machine
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def test_trampoline_registry(self):
+        registry = StateRegistry()
+
+        class Object(object):
+            @state(transitions_to="second", trampoline=True,
+                   registry=registry)
+            def initial(self):
+                self.second()
+
+            @state
+            def second(self):
+                sleep(.01)
+
+        state_machine = Object().initial()
+        sleep()
+        self.assertEqual(registry.snapshot(), {Object.second.state: 1})
+        state_machine.join()
+        self.assertEqual(len(registry), 0)
+
+        state_machine = Object().initial()
+        self.assertEqual(registry.snapshot(), {Object.initial.state: 1})
+        state_machine._state_greenlet.kill()
+        sleep()
+        self.assertEqual(len(registry), 0)
+
+    def test_compact_machine(self):
+        class Object(object):
+            @state
+            def initial(self):
+                pass
+
+        state_machine = Object().initial()
+        state_machine.join()
+        self.assertFalse(hasattr(state_machine, '__dict__'))
+        # no generator unless the state coroutine is overridden
+        self.assertNotIsInstance(state_machine._state_coroutine,
+                                 types.GeneratorType)
+        with self.transition_tracking():
+            state_machine = Object().initial()
+            state_machine.join()
+        self.assertIsInstance(state_machine._state_coroutine,
+                              types.GeneratorType)
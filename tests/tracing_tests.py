@@ -0,0 +1,141 @@
+import json
+from StringIO import StringIO
+from gevent import spawn, sleep, GreenletExit, Timeout
+from unittest2 import TestCase
+from async import DeferredCallHandler, Tracer, ChromeTraceRecorder
+from async import add_tracer, remove_tracer, start_trace, current_context
+from async import state
+
+
+class _Recorder(Tracer):
+    def __init__(self):
+        self.events = []
+
+    def call_queued(self, target, call):
+        self.events.append(('queued', call.name, call.trace_context))
+
+    def call_started(self, target, call):
+        self.events.append(('started', call.name, current_context()))
+
+    def call_finished(self, target, call, error):
+        self.events.append(('finished', call.name, error))
+
+    def transition(self, machine, from_state, to_state, context):
+        self.events.append(('transition', to_state.name, context))
+
+
+class _Backend(DeferredCallHandler):
+    def __init__(self):
+        super(_Backend, self).__init__()
+        self.contexts = []
+
+    def store(self, value):
+        self.contexts.append(current_context())
+
+    def slow(self):
+        sleep(1)
+
+
+class _Frontend(DeferredCallHandler):
+    def __init__(self, backend):
+        super(_Frontend, self).__init__()
+        self.backend = backend
+
+    def handle(self, value):
+        if value is None:
+            raise ValueError()
+        self.backend.oneway.store(value)
+
+
+class _Machine(object):
+    @state(transitions_to=['second'])
+    def first(self):
+        self.second()
+
+    @state
+    def second(self):
+        pass
+
+
+class TestTracing(TestCase):
+
+    def setUp(self):
+        self.recorder = _Recorder()
+        add_tracer(self.recorder)
+        self.addCleanup(remove_tracer, self.recorder)
+
+    def test_propagation(self):
+        backend = _Backend()
+        frontend = _Frontend(backend)
+        processors = [spawn(handler.process, forever=True)
+                      for handler in (frontend, backend)]
+        root = start_trace()
+        frontend.sync.handle(1)
+        self.assertRaises(ValueError, frontend.sync.handle, None)
+        backend.sync.store(2)
+        for handler in (frontend, backend):
+            handler.stop_processing()
+        for processor in processors:
+            processor.join()
+
+        handle, store = [context for kind, name, context
+                         in self.recorder.events if kind == 'queued'][:2]
+        self.assertEqual(handle.trace_id, root.trace_id)
+        self.assertEqual(handle.parent_id, root.span_id)
+        # the call made while handling the first one is part of its trace
+        self.assertEqual(store.parent_id, handle.span_id)
+        self.assertEqual(backend.contexts[0], store)
+        started = [context for kind, name, context in self.recorder.events
+                   if kind == 'started']
+        self.assertEqual(started[0], handle)
+        errors = [error for kind, name, error in self.recorder.events
+                  if kind == 'finished' and name == 'handle']
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], ValueError)
+        self.assertIs(current_context(), root)
+
+    def test_interrupted_calls(self):
+        backend = _Backend()
+        processor = spawn(backend.process, forever=True)
+        spawn(backend.sync.slow)
+        sleep()
+        processor.kill()
+        self.assertIsInstance(processor.value, GreenletExit)
+        self.assertIsInstance(self.recorder.events[-1][2], GreenletExit)
+
+        # the processing greenlet gets its context back
+        root = start_trace()
+        backend.oneway.slow()
+        with self.assertRaises(Timeout):
+            with Timeout(.01):
+                backend.process()
+        self.assertIs(current_context(), root)
+        self.assertEqual(self.recorder.events[-1][:2], ('finished', 'slow'))
+
+    def test_transitions(self):
+        root = start_trace()
+        _Machine().first().join(timeout=1)
+        transitions = [(name, context) for kind, name, context
+                       in self.recorder.events if kind == 'transition']
+        self.assertEqual(transitions, [('first', root), ('second', root)])
+
+    def test_chrome_trace(self):
+        recorder = ChromeTraceRecorder()
+        add_tracer(recorder)
+        self.addCleanup(remove_tracer, recorder)
+        backend = _Backend()
+        start_trace()
+        backend.oneway.store(1)
+        backend.process()
+        _Machine().first().join(timeout=1)
+        output = StringIO()
+        recorder.dump(output)
+        events = json.loads(output.getvalue())['traceEvents']
+        phases = [event['ph'] for event in events if event['ph'] != 'M']
+        self.assertEqual(phases, ['s', 'f', 'X', 'i', 'i'])
+        flows = [event for event in events if event['ph'] in 'sf']
+        self.assertEqual(flows[0]['id'], flows[1]['id'])
+        execution = [event for event in events if event['ph'] == 'X'][0]
+        self.assertEqual(execution['name'], 'store')
+        self.assertEqual(execution['args']['span_id'],
+                         '{:x}'.format(flows[0]['id']))
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+from gevent import sleep, spawn, Timeout
+from unittest2 import TestCase
+from async import DeferredCallHandler, HandlerServer, HandlerClient
+from async import RemoteError, wait_all
+from async.remote import msgpack
+
+
+class Kaboom(Exception):
+    pass
+
+
+class _Handler(DeferredCallHandler):
+    def __init__(self):
+        super(_Handler, self).__init__()
+        self.values = []
+
+    def store(self, value):
+        self.values.append(value)
+
+    def stored(self):
+        return self.values
+
+    def double(self, value):
+        return value * 2
+
+    def slow(self):
+        sleep(.2)
+
+    def kaboom(self):
+        raise Kaboom("oh no")
+
+
+class TestTransport(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'handler.sock')
+        self.handler = _Handler()
+        self.processor = spawn(self.handler.process, forever=True)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        self.handler.stop_processing()
+        self.processor.join()
+        shutil.rmtree(self.directory)
+
+    def serve(self, serializer=None):
+        server = HandlerServer(self.handler, self.path, serializer)
+        server.start()
+        self.servers.append(server)
+        return server
+
+    def test_calls(self):
+        self.serve()
+        client = HandlerClient(self.path)
+        try:
+            for value in range(10):
+                client.oneway.store(value)
+            self.assertEqual(client.sync.stored(), range(10))
+            self.assertRaises(Kaboom, client.sync.kaboom)
+            self.assertRaises(Timeout, client.sync(timeout=.01).slow)
+            # pipelined over the same connection
+            futures = [client.deferred.double(value) for value in range(100)]
+            self.assertEqual(wait_all(futures, timeout=2),
+                             [value * 2 for value in range(100)])
+        finally:
+            client.close()
+        self.assertRaises(RemoteError, client.sync.stored)
+
+    def test_socket_mode(self):
+        self.serve()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_timed_out_call_cancelled(self):
+        self.serve()
+        client = HandlerClient(self.path)
+        try:
+            client.oneway.slow()
+            self.assertRaises(Timeout, client.sync(timeout=.01).store, 1)
+            future = client.deferred.store(2)
+            self.assertTrue(future.cancel())
+            self.assertEqual(client.sync.stored(), [])
+        finally:
+            client.close()
+        self.assertEqual(self.handler.cancelled_count, 2)
+
+    def test_connection_pool(self):
+        self.serve()
+        client = HandlerClient(self.path, connections=3)
+        try:
+            futures = [client.deferred.double(value) for value in range(30)]
+            self.assertEqual(wait_all(futures, timeout=2),
+                             [value * 2 for value in range(30)])
+        finally:
+            client.close()
+
+    def test_json(self):
+        self.serve('json')
+        client = HandlerClient(self.path, 'json')
+        try:
+            self.assertEqual(client.sync.double(21), 42)
+            with self.assertRaises(RemoteError) as context:
+                client.sync.kaboom()
+            self.assertIn('Kaboom', str(context.exception))
+        finally:
+            client.close()
+
+    def test_msgpack(self):
+        if msgpack is None:
+            self.skipTest("msgpack is not available")
+        self.serve('msgpack')
+        client = HandlerClient(self.path, 'msgpack')
+        try:
+            self.assertEqual(client.sync.double(21), 42)
+            self.assertRaises(RemoteError, client.sync.kaboom)
+        finally:
+            client.close()